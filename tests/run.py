@@ -11,6 +11,13 @@ from tests.test_models import *
 from tests.test_upload import *
 from tests.test_ssl_crt import *
 from tests.test_scan import *
+from tests.test_search import *
+from tests.test_library import *
+from tests.test_ranking import *
+from tests.test_limiter import *
+from tests.test_stats import *
+from tests.test_principals import *
+from tests.test_thumbnails import *
 from tests.test_admin import *
 from tests.test_utils import *
 import unittest
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from webserver.library import (
+    BookIds,
+    CategoryBooks,
+    CategoryCounts,
+    FormatSizes,
+    FormattedBooks,
+    LibraryWatcher,
+    decode_cursor,
+    encode_cursor,
+    seek,
+)
+
+
+class FakeCache:
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def all_book_ids(self):
+        return frozenset(self.ids)
+
+
+class TestCursor(unittest.TestCase):
+    def test_encode(self):
+        for key in [(1,), (8, 123), (0, -1)]:
+            self.assertEqual(decode_cursor(encode_cursor(key)), key)
+        self.assertEqual(decode_cursor("not a cursor"), None)
+        self.assertEqual(decode_cursor(encode_cursor(["x"])), None)
+        self.assertEqual(decode_cursor(""), None)
+
+    def test_seek(self):
+        keys = [(9, 5), (8, 7), (8, 3), (2, 4)]
+        key_at = lambda i: keys[i]  # noqa: E731
+        self.assertEqual(seek(len(keys), key_at, (8, 7)), 2)
+        self.assertEqual(seek(len(keys), key_at, (8, 5)), 2)  # 游标对应的书籍已被删除
+        self.assertEqual(seek(len(keys), key_at, (10, 0)), 0)
+        self.assertEqual(seek(len(keys), key_at, (2, 4)), 4)
+
+        ids = [1, 3, 5, 7]
+        self.assertEqual(seek(len(ids), lambda i: (ids[i],), (3,), reverse=False), 2)
+        self.assertEqual(seek(len(ids), lambda i: (ids[i],), (4,), reverse=False), 2)
+
+
+class TestLibraryWatcher(unittest.TestCase):
+    def test_changed(self):
+        calls = []
+        w = LibraryWatcher()
+        w.subscribe(calls.append)
+        w.subscribe(lambda ids: 1 / 0)
+        w.changed([1, "2"])
+        w.changed()
+        self.assertEqual(calls, [{1, 2}, None])
+        self.assertEqual(w.version, 2)
+
+    def test_parse_event(self):
+        class Event:
+            def __init__(self, name):
+                self.name = name
+
+        w = LibraryWatcher()
+        self.assertEqual(w.parse_event(Event("metadata_changed"), ("title", {1, 2})), {1, 2})
+        self.assertEqual(w.parse_event(Event("book_created"), (3,)), [3])
+        self.assertEqual(w.parse_event(Event("books_removed"), ((4, 5),)), (4, 5))
+        self.assertEqual(w.parse_event(Event("format_added"), (6, "EPUB")), [6])
+        self.assertEqual(w.parse_event(Event("formats_removed"), ({7: ("EPUB", "PDF")},)), [7])
+        self.assertEqual(w.parse_event(Event("items_renamed"), ("tags", {1: 2})), None)
+
+
+class TestBookIds(unittest.TestCase):
+    def test_refresh(self):
+        cache = FakeCache([3, 1, 2])
+        ids = BookIds(cache)
+        ids.refresh()
+        self.assertEqual(list(ids.ids), [3, 2, 1])
+        self.assertEqual(list(ids.ascending), [1, 2, 3])
+        self.assertEqual(len(ids), 3)
+
+        ids.on_library_changed([2])
+        self.assertEqual(ids.version, 1)
+
+        cache.ids.add(9)
+        ids.on_library_changed([9])
+        self.assertEqual(list(ids.ids), [9, 3, 2, 1])
+        self.assertEqual(ids.version, 2)
+
+        cache.ids.remove(3)
+        ids.on_library_changed(None)
+        self.assertEqual(list(ids.ids), [9, 2, 1])
+        self.assertEqual(list(ids.ascending), [1, 2, 9])
+
+    def test_sample(self):
+        ids = BookIds(FakeCache(range(1, 201)))
+        ids.refresh()
+        self.assertEqual(len(set(ids.sample(10))), 10)
+        self.assertTrue(all(i > 100 for i in ids.sample(30, population=100)))
+        self.assertEqual(len(ids.sample(300)), 200)
+
+
+class FakeMetaCache:
+    def __init__(self, books):
+        self.books = books
+
+    def all_book_ids(self):
+        return frozenset(self.books)
+
+    def all_field_for(self, field, book_ids):
+        return dict((i, self.books[i].get(field) if i in self.books else None) for i in book_ids)
+
+    def values(self, book, field):
+        val = book.get(field)
+        return val if isinstance(val, tuple) else (val,)
+
+    def get_item_id(self, field, name):
+        for b in self.books.values():
+            for v in self.values(b, field):
+                if v is not None and str(v).lower() == str(name).lower():
+                    return v
+        return None
+
+    def books_for_field(self, field, item_id):
+        return set(i for i, b in self.books.items() if item_id in self.values(b, field))
+
+
+class TestCategoryBooks(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeMetaCache(
+            {
+                1: {"tags": ("Novel",), "rating": 8, "series": None},
+                2: {"tags": ("Novel", "History"), "rating": None, "series": "S"},
+                3: {"tags": ("Novel",), "rating": 8, "series": None},
+                4: {"tags": (), "rating": 10, "series": None},
+            }
+        )
+        self.index = CategoryBooks(self.cache)
+
+    def test_get(self):
+        self.assertEqual(list(self.index.get("tags", "novel")), [3, 1, 2])
+        self.assertEqual(list(self.index.get("tags", "History")), [2])
+        self.assertEqual(list(self.index.get("tags", "nothing")), [])
+        self.assertEqual(list(self.index.get("rating", 8)), [3, 1])
+        self.assertEqual(list(self.index.get("rating", 0)), [2])
+        ids, ratings = self.index.get_ranked("tags", "Novel")
+        self.assertEqual(list(zip(ratings, ids)), [(8, 3), (8, 1), (0, 2)])
+
+    def test_invalidate(self):
+        self.assertEqual(list(self.index.get("tags", "Novel")), [3, 1, 2])
+        self.assertEqual(list(self.index.get("tags", "History")), [2])
+        self.assertEqual(list(self.index.get("series", "S")), [2])
+
+        # 评分变化，影响排序
+        self.cache.books[2]["rating"] = 10
+        self.index.on_library_changed({2})
+        self.assertEqual(list(self.index.get("tags", "Novel")), [2, 3, 1])
+
+        # 新增标签，之前不包含该书的分类也要失效
+        self.index.get("tags", "Short")
+        self.cache.books[4]["tags"] = ("Short",)
+        self.index.on_library_changed({4})
+        self.assertEqual(list(self.index.get("tags", "Short")), [4])
+        self.assertTrue(("tags", "novel") in self.index.entries)
+
+        del self.cache.books[2]
+        self.index.on_library_changed({2})
+        self.assertEqual(list(self.index.get("tags", "Novel")), [3, 1])
+        self.assertEqual(list(self.index.get("series", "S")), [])
+
+    def test_invalidate_while_loading(self):
+        load = self.index.load
+
+        def slow_load(field, name):
+            result = load(field, name)
+            # 读取完成、写入缓存之前，书籍的标签被修改
+            self.cache.books[2]["tags"] = ("History",)
+            self.index.on_library_changed({2})
+            return result
+
+        self.index.load = slow_load
+        self.assertEqual(list(self.index.get("tags", "Novel")), [3, 1, 2])
+        self.assertTrue(("tags", "novel") not in self.index.entries)
+        self.index.load = load
+        self.assertEqual(list(self.index.get("tags", "Novel")), [3, 1])
+
+    def test_lru(self):
+        self.index.MAX_ENTRIES = 2
+        self.index.get("tags", "Novel")
+        self.index.get("tags", "History")
+        self.index.get("tags", "Novel")
+        self.index.get("rating", 8)
+        self.assertEqual(list(self.index.entries.keys()), [("tags", "novel"), ("rating", 8)])
+
+
+class TestCategoryCounts(unittest.TestCase):
+    def test_get(self):
+        calls = []
+
+        def load():
+            calls.append(1)
+            return {"Novel": len(calls)}
+
+        watcher = LibraryWatcher()
+        counts = CategoryCounts(watcher)
+        self.assertEqual(counts.get("tags", load), {"Novel": 1})
+        self.assertEqual(counts.get("tags", load), {"Novel": 1})
+        self.assertEqual(len(calls), 1)
+
+        watcher.changed([1])
+        self.assertEqual(counts.get("tags", load), {"Novel": 2})
+        self.assertEqual(counts.get("other", lambda: 0), 0)
+        self.assertEqual(len(calls), 2)
+
+
+class TestFormattedBooks(unittest.TestCase):
+    def test_get(self):
+        cache = FormattedBooks(max_entries=2)
+        book = {"id": 1, "last_modified": 100}
+        build = lambda: {"id": book["id"], "ts": book["last_modified"]}  # noqa: E731
+
+        data = cache.get("card", book, "cdn", build)
+        data["fav"] = True
+        self.assertEqual(cache.get("card", book, "cdn", build), {"id": 1, "ts": 100})
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 1, "misses": 1})
+
+        # 书籍修改后，last_modified变化，不再命中旧数据
+        book["last_modified"] = 200
+        self.assertEqual(cache.get("card", book, "cdn", build), {"id": 1, "ts": 200})
+        self.assertEqual(cache.misses, 2)
+
+        cache.get("card", {"id": 2, "last_modified": 1}, "cdn", lambda: {"id": 2})
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(set(cache.keys.keys()), {1, 2})
+
+    def test_invalidate(self):
+        cache = FormattedBooks()
+        for i in range(1, 4):
+            cache.get("card", {"id": i}, "cdn", lambda: {})
+            cache.get("detail", {"id": i}, "cdn", lambda: {})
+        cache.invalidate(1)
+        self.assertEqual(len(cache.entries), 4)
+        cache.on_library_changed({2})
+        self.assertEqual(set(k[1] for k in cache.entries), {3})
+        cache.on_library_changed(None)
+        self.assertEqual(cache.stats()["size"], 0)
+
+
+class FakeConn:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get(self, sql):
+        if "WHERE" not in sql:
+            return list(self.rows)
+        ids = [int(i) for i in sql.split("(")[-1].rstrip(")").split(",")]
+        return [r for r in self.rows if r[0] in ids]
+
+
+class FakeFormatCache:
+    def __init__(self, rows):
+        self.backend = type("Backend", (), {"conn": FakeConn(rows)})()
+
+
+class TestFormatSizes(unittest.TestCase):
+    def test_sizes(self):
+        cache = FakeFormatCache([(1, "EPUB", 100), (1, "PDF", 200), (2, "TXT", 5)])
+        sizes = FormatSizes(cache)
+        sizes.refresh()
+        self.assertEqual(sizes.size(1, "epub"), 100)
+        self.assertEqual(sizes.size("2", "TXT"), 5)
+        self.assertEqual(sizes.size(2, "epub"), None)
+
+        cache.backend.conn.rows = [(1, "EPUB", 101), (2, "TXT", 5), (3, "MOBI", 7)]
+        sizes.on_library_changed({1, 3})
+        self.assertEqual(sizes.size(1, "epub"), 101)
+        self.assertEqual(sizes.size(1, "pdf"), None)
+        self.assertEqual(sizes.size(3, "mobi"), 7)
+
+        cache.backend.conn.rows = [(3, "MOBI", 7)]
+        sizes.on_library_changed([2])
+        self.assertEqual(sizes.size(2, "txt"), None)
+        self.assertTrue(2 not in sizes.sizes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from webserver.limiter import DownloadLimiter
+
+
+class TestDownloadLimiter(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.limiter = DownloadLimiter(window=100, clock=lambda: self.now)
+
+    def test_sliding_window(self):
+        acquire = self.limiter.acquire
+        self.assertEqual(acquire([("1.2.3.4", 2)]), None)
+        self.now += 50
+        self.assertEqual(acquire([("1.2.3.4", 2)]), None)
+        self.assertEqual(acquire([("1.2.3.4", 2)]), ("1.2.3.4", 2))
+        self.assertEqual(acquire([("5.6.7.8", 2)]), None)
+
+        # 第一次下载滑出窗口后，可以再下载一次
+        self.now += 50
+        self.assertEqual(acquire([("1.2.3.4", 2)]), None)
+        self.assertEqual(acquire([("1.2.3.4", 2)]), ("1.2.3.4", 2))
+
+    def test_disabled(self):
+        for i in range(10):
+            self.assertEqual(self.limiter.acquire([("1.2.3.4", 0)]), None)
+        self.assertEqual(self.limiter.hits, {})
+
+    def test_ip_and_user(self):
+        acquire = self.limiter.acquire
+        self.assertEqual(acquire([("1.2.3.4", 3), ("user:1", 1)]), None)
+        self.assertEqual(acquire([("1.2.3.4", 3), ("user:1", 1)]), ("user:1", 1))
+        # 超限的请求不计数
+        self.assertEqual(len(self.limiter.hits["1.2.3.4"]), 1)
+        self.assertEqual(acquire([("1.2.3.4", 3)]), None)
+        self.assertEqual(acquire([("1.2.3.4", 3), ("user:2", 1)]), None)
+        self.assertEqual(acquire([("1.2.3.4", 3), ("user:3", 1)]), ("1.2.3.4", 3))
+
+    def test_prune(self):
+        self.limiter.acquire([("1.2.3.4", 2)])
+        self.now += 60
+        self.limiter.acquire([("5.6.7.8", 2)])
+        self.now += 60
+        self.limiter.prune()
+        self.assertEqual(list(self.limiter.hits.keys()), ["5.6.7.8"])
+        self.limiter.snapshot()  # 未配置数据库时，只清理内存
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -59,6 +59,7 @@ def setup_server():
     main.CONF["html_path"] = "/tmp/"
     main.CONF["settings_path"] = "/tmp/"
     main.CONF["progress_path"] = "/tmp/"
+    main.CONF["thumbnail_path"] = "/tmp/talebook-thumbnails/"
     main.CONF["nuxt_env_path"] = "/tmp/.env.text"
     main.CONF["installed"] = True
     main.CONF["INVITE_MODE"] = False
@@ -97,6 +98,7 @@ class FakeHandler(BaseHandler):
         h.rsp = None
         h.cookie = {}
         h.session = get_db()
+        h.credentials = _app.settings["credentials"]
 
     def write(self, rsp):
         self.rsp = rsp
@@ -199,6 +201,30 @@ class TestAppWithoutLogin(TestApp):
         d = self.json("/api/recent")
         self.assert_book_list(d, 10)
 
+    def test_books_batch(self):
+        d = self.json("/api/books?ids=%d,%d,%d,99999" % (BID_TXT, BID_EPUB, BID_TXT))
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual([b["id"] for b in d["books"]], [BID_TXT, BID_EPUB])
+        self.assertTrue("img" in d["books"][0])
+
+        d = self.json("/api/books?ids=%d&fields=title,tags,files" % BID_EPUB)
+        self.assertEqual(sorted(d["books"][0].keys()), ["files", "id", "tags", "title"])
+        self.gt(len(d["books"][0]["files"]), 1)
+
+        d = self.json("/api/books?ids=a,b")
+        self.assertEqual(d["err"], "params.invalid")
+        d = self.json("/api/books?ids=" + ",".join(str(i) for i in range(400)))
+        self.assertEqual(d["err"], "params.invalid")
+
+    def test_not_modified(self):
+        rsp = self.fetch("/api/recent")
+        self.assertEqual(rsp.code, 200)
+        etag = rsp.headers["Etag"]
+        rsp = self.fetch("/api/recent", headers={"If-None-Match": etag})
+        self.assertEqual(rsp.code, 304)
+        rsp = self.fetch("/api/recent?start=1", headers={"If-None-Match": etag})
+        self.assertEqual(rsp.code, 200)
+
     def test_download(self):
         rsp = self.fetch("/api/book/1.epub", follow_redirects=False)
         self.assertEqual(rsp.code, 302)
@@ -260,12 +286,17 @@ class AutoResetPermission:
         self.arg = arg
 
     def __enter__(self):
+        # 测试中直接修改用户权限，关闭权限缓存以便立即生效
+        self.principals = _app.settings["principals"]
+        self.ttl, self.principals.ttl = self.principals.ttl, 0
         self.user = get_db().query(models.Reader).filter(self.arg).first()
         self.user.permission = ""
         return self.user
 
     def __exit__(self, type, value, trace):
         self.user.permission = ""
+        self.principals.ttl = self.ttl
+        self.principals.invalidate()
 
 
 def mock_permission(arg=None):
@@ -335,12 +366,75 @@ class TestFile(TestWithUserLogin):
         rsp = self.fetch("/get/thumb_80x80/1.jpg", follow_redirects=False)
         self.assertEqual(rsp.code, 200)
 
+    def test_cover_format(self):
+        with mock.patch("webserver.handlers.files.negotiate_format", return_value="webp"):
+            with mock.patch("webserver.thumbnails.make_thumbnail", return_value=b"webp"):
+                rsp = self.fetch("/get/thumb_60x80/1.jpg", headers={"Accept": "image/webp"})
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(rsp.headers["Content-Type"], "image/webp")
+        self.assertEqual(rsp.headers["Vary"], "Accept")
+
+    def test_thumbnail_encoder(self):
+        # 不替换编码器，确认calibre可以缩放封面，以及只转换格式
+        from webserver.thumbnails import make_thumbnail
+
+        with open(main.CONF["resource_path"] + "/calibre/default_cover.jpg", "rb") as f:
+            cover = f.read()
+        for width, height in [(60, 80), (0, 0)]:
+            data = make_thumbnail(cover, width, height, "jpg")
+            self.assertEqual(data[:2], b"\xff\xd8")
+
+    def test_not_modified(self):
+        ts = self.json("/api/book/1")["book"]["img"].split("?t=")[-1]
+        for url in ["/get/thumb_60x80/1.jpg", "/get/cover/1.jpg", "/get/opf/1"]:
+            rsp = self.fetch(url + "?t=123")
+            self.assertEqual(rsp.code, 200)
+            self.assertTrue("immutable" not in rsp.headers.get("Cache-Control", ""))
+            rsp = self.fetch(url + "?t=" + ts)
+            self.assertEqual(rsp.code, 200)
+            self.assertTrue("immutable" in rsp.headers["Cache-Control"])
+
+            rsp = self.fetch(url, headers={"If-None-Match": rsp.headers["Etag"]})
+            self.assertEqual(rsp.code, 304)
+            rsp = self.fetch(url, headers={"If-None-Match": '"other"'})
+            self.assertEqual(rsp.code, 200)
+            rsp = self.fetch(url, headers={"If-Modified-Since": rsp.headers["Last-Modified"]})
+            self.assertEqual(rsp.code, 304)
+
     def test_get_opf(self):
         rsp = self.fetch("/get/opf/1", follow_redirects=False)
         self.assertEqual(rsp.code, 200)
 
+    def test_sprite(self):
+        url = "/get/sprite_60x80/1,2,99999.jpg"
+        rsp = self.fetch(url)
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(rsp.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(rsp.body[:2], b"\xff\xd8")
+
+        rsp = self.fetch(url, headers={"If-None-Match": rsp.headers["Etag"]})
+        self.assertEqual(rsp.code, 304)
+
+        ids = ",".join(str(i) for i in range(1, 102))
+        for url in ["/get/sprite_60x80/%s.jpg" % ids, "/get/sprite_0x80/1.jpg", "/get/sprite_60x800/1.jpg"]:
+            self.assertEqual(self.fetch(url).code, 400)
+
 
 class TestBook(TestWithUserLogin):
+    def test_detail_not_modified(self):
+        rsp = self.fetch("/api/book/1")
+        self.assertEqual(rsp.code, 200)
+        d = json.loads(rsp.body)
+        self.assertTrue("count_visit" not in d["book"])
+        counts = self.json("/api/book/1/counts")
+        self.assertEqual(counts["err"], "ok")
+
+        # 第二次请求命中缓存，但仍然记录访问次数
+        rsp = self.fetch("/api/book/1", headers={"If-None-Match": rsp.headers["Etag"]})
+        self.assertEqual(rsp.code, 304)
+        self.assertEqual(self.json("/api/book/1/counts")["count_visit"], counts["count_visit"] + 1)
+        self.assertEqual(self.json("/api/book/99999/counts")["err"], "params.book.invalid")
+
     def test_nav(self):
         rsp = self.fetch("/api/book/nav")
         self.assertEqual(rsp.code, 200)
@@ -352,6 +446,40 @@ class TestBook(TestWithUserLogin):
         rsp = self.fetch("/api/book/1.pdf")
         self.assertEqual(rsp.code, 404)
 
+    def test_download_range(self):
+        rsp = self.fetch("/api/book/1.epub")
+        self.assertEqual(rsp.code, 200)
+        body, etag = rsp.body, rsp.headers["Etag"]
+        self.assertEqual(rsp.headers["Accept-Ranges"], "bytes")
+
+        rsp = self.fetch("/api/book/1.epub", headers={"Range": "bytes=0-9"})
+        self.assertEqual(rsp.code, 206)
+        self.assertEqual(rsp.body, body[:10])
+        self.assertEqual(rsp.headers["Content-Range"], "bytes 0-9/%d" % len(body))
+
+        rsp = self.fetch("/api/book/1.epub", headers={"Range": "bytes=10-", "If-Range": etag})
+        self.assertEqual(rsp.code, 206)
+        self.assertEqual(rsp.body, body[10:])
+
+        # 文件已经变化，返回完整的文件
+        rsp = self.fetch("/api/book/1.epub", headers={"Range": "bytes=10-", "If-Range": '"stale"'})
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(rsp.body, body)
+
+        rsp = self.fetch("/api/book/1.epub", headers={"Range": "bytes=%d-" % len(body)})
+        self.assertEqual(rsp.code, 416)
+
+        rsp = self.fetch("/api/book/1.epub", headers={"If-None-Match": etag})
+        self.assertEqual(rsp.code, 304)
+
+    def test_download_accel_redirect(self):
+        with mock.patch.dict(main.CONF, {"download_accel_redirect": "/_library/"}):
+            rsp = self.fetch("/api/book/1.epub", headers={"Range": "bytes=0-9"})
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(rsp.body, b"")
+        self.assertTrue(rsp.headers["X-Accel-Redirect"].startswith("/_library/"))
+        self.assertTrue(rsp.headers["X-Accel-Redirect"].endswith(".epub"))
+
     def test_download_permission(self):
         with mock_permission() as user:
             user.set_permission("S")  # forbid
@@ -606,10 +734,25 @@ class TestAdmin(TestWithAdminUser):
         self.assertEqual(d["err"], "ok")
         self.assertEqual(d["users"]["total"], 31)
 
+        # 迁移后历史记录保存在reader_history表中，列表返回每类记录的书籍数
+        uid = d["users"]["items"][0]["id"]
+        session = get_db()
+        for book_id in [1, 2, 1]:
+            session.add(models.ReaderHistory(uid, "visit_history", book_id))
+        session.commit()
+        try:
+            d = self.json("/api/admin/users")
+            user = [u for u in d["users"]["items"] if u["id"] == uid][0]
+            self.assertEqual(user["history"], {"visit_history": 2})
+        finally:
+            session.query(models.ReaderHistory).filter(models.ReaderHistory.reader_id == uid).delete()
+            session.commit()
+
     def test_admin_settings(self):
         d = self.json("/api/admin/settings")
         self.assertEqual(d["err"], "ok")
         self.assertTrue(len(d["settings"]) > 10)
+        self.assertEqual(sorted(d["caches"]["formatted_books"].keys()), ["hits", "misses", "size"])
 
         with mock.patch.object(loader.SettingsLoader, "set_store_path", return_value="/tmp/"):
             req = {"site_title": "abc", "not_work": "en"}
@@ -737,6 +880,13 @@ class TestJsonResponse(TestApp):
         self.assertEqual(f.rsp, "")
         self.assertHeaders(f.rsp_headers)
 
+    def test_not_modified(self):
+        f = FakeHandler()
+        webserver.handlers.base.js(lambda x: self.raise_(webserver.handlers.base.NotModified()))(f)
+        self.assertEqual(f.rsp, None)
+        self.assertEqual(f.get_status(), 304)
+        self.assertHeaders(f.rsp_headers)
+
 
 class TestInviteMode(TestApp):
     def setUp(self):
@@ -5,7 +5,10 @@ import json
 import logging
 import unittest
 
-from webserver import models
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from webserver import models, utils
 
 
 class TestUser(unittest.TestCase):
@@ -27,6 +30,71 @@ class TestUser(unittest.TestCase):
         self.assertEqual(len(a.extra["download_history"]), n)
 
 
+class TestReaderHistory(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        models.user_syncdb(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.user = models.Reader()
+        self.user.username = "history"
+        self.user.extra = {"kindle_email": ""}
+        self.session.add(self.user)
+        self.session.commit()
+
+    def test_history(self):
+        for book_id in [1, 2, 1, 3]:
+            utils.save_user_his(self.session, "visit_history", self.user, book_id)
+        utils.save_user_his(self.session, "fav_history", self.user, 2)
+        his = utils.get_user_his(self.session, self.user.id)
+        self.assertEqual(his, {"visit_history": [3, 1, 2], "fav_history": [2]})
+        self.assertTrue(utils.has_user_his(self.session, "fav_history", self.user.id, 2))
+        self.assertFalse(utils.has_user_his(self.session, "fav_history", self.user.id, 1))
+
+        utils.del_user_his(self.session, "fav_history", self.user.id, 2)
+        self.assertFalse(utils.has_user_his(self.session, "fav_history", self.user.id, 2))
+        utils.del_user_his(self.session, "visit_history", self.user.id)
+        self.assertEqual(utils.get_user_his(self.session, self.user.id), {})
+
+    def test_retention(self):
+        models.ReaderHistory.MAX_PER_ACTION = 3
+        try:
+            for book_id in [1, 2, 3, 1, 4, 5, 5]:
+                utils.save_user_his(self.session, "read_history", self.user, book_id)
+            utils.save_user_his(self.session, "fav_history", self.user, 1)
+            self.assertEqual(self.session.query(models.ReaderHistory).count(), 8)
+            models.trim_reader_history(self.session)
+        finally:
+            models.ReaderHistory.MAX_PER_ACTION = 200
+        self.assertEqual(self.session.query(models.ReaderHistory).count(), 4)
+        self.assertEqual(utils.get_user_his(self.session, self.user.id), {"read_history": [5, 4, 1], "fav_history": [1]})
+
+    def test_migrate(self):
+        self.user.extra["visit_history"] = [3, 1, 3, 2]
+        self.user.extra["fav_history"] = []
+        self.session.commit()
+        models.migrate_reader_history(self.session)
+        self.assertEqual(utils.get_user_his(self.session, self.user.id), {"visit_history": [3, 1, 2]})
+        self.assertEqual(dict(self.user.extra), {"kindle_email": ""})
+
+        # 已经迁移过，不再扫描用户表
+        self.user.extra["visit_history"] = [9]
+        self.session.commit()
+        models.migrate_reader_history(self.session)
+        self.assertEqual(utils.get_user_his(self.session, self.user.id), {"visit_history": [3, 1, 2]})
+
+        models.trim_reader_history(self.session)
+        self.assertEqual(utils.get_user_his(self.session, self.user.id), {"visit_history": [3, 1, 2]})
+
+    def test_count(self):
+        self.user.extra["visit_history"] = [3, 1, 3, 2]
+        self.user.extra["read_history"] = [1]
+        self.session.commit()
+        models.migrate_reader_history(self.session)
+        utils.save_user_his(self.session, "visit_history", self.user, 1)
+        counts = utils.count_user_his(self.session, [self.user.id, self.user.id + 1])
+        self.assertEqual(counts, {self.user.id: {"visit_history": 3, "read_history": 1}})
+        self.assertEqual(utils.count_user_his(self.session, []), {})
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.DEBUG,
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from webserver.principals import CredentialCache, PrincipalCache
+
+
+class FakeUser:
+    def __init__(self, user_id, permission=""):
+        self.id = user_id
+        self.permission = permission
+
+
+class FakePrincipalCache(PrincipalCache):
+    def __init__(self, users):
+        self.now = 1000
+        super(FakePrincipalCache, self).__init__(ttl=60, clock=lambda: self.now)
+        self.users = users
+        self.loads = 0
+
+    def load(self, session, user_id):
+        self.loads += 1
+        return self.users.get(user_id)
+
+
+class TestPrincipalCache(unittest.TestCase):
+    def test_get(self):
+        users = {1: FakeUser(1, "s")}
+        cache = FakePrincipalCache(users)
+        self.assertEqual(cache.get(None, 1).permission, "s")
+        self.assertEqual(cache.get(None, 1).permission, "s")
+        self.assertEqual(cache.loads, 1)
+
+        # 不存在的用户不缓存
+        self.assertEqual(cache.get(None, 2), None)
+        users[2] = FakeUser(2)
+        self.assertEqual(cache.get(None, 2).id, 2)
+
+        users[1] = FakeUser(1, "S")
+        self.assertEqual(cache.get(None, 1).permission, "s")
+        cache.now += 61
+        self.assertEqual(cache.get(None, 1).permission, "S")
+
+    def test_invalidate(self):
+        users = {1: FakeUser(1, "s"), 2: FakeUser(2)}
+        cache = FakePrincipalCache(users)
+        cache.get(None, 1)
+        cache.get(None, 2)
+        users[1] = FakeUser(1, "S")
+        cache.invalidate("1")
+        self.assertEqual(cache.get(None, 1).permission, "S")
+        self.assertEqual(cache.loads, 3)
+        cache.invalidate()
+        cache.get(None, 2)
+        self.assertEqual(cache.loads, 4)
+
+
+class TestCredentialCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = CredentialCache(ttl=300, touch_interval=60, clock=lambda: self.now)
+
+    def test_get(self):
+        c = self.cache
+        self.assertEqual(c.get("admin", "pass"), None)
+        c.add("admin", "pass", 1)
+        self.assertEqual(c.get("admin", "pass"), 1)
+        self.assertEqual(c.get("admin", "wrong"), None)
+        self.assertFalse(any("pass" in k for k in c.entries))
+        self.now += 301
+        self.assertEqual(c.get("admin", "pass"), None)
+        self.assertEqual(c.entries, {})
+
+    def test_invalidate(self):
+        c = self.cache
+        c.add("admin", "pass", 1)
+        c.add("admin", "old", 1)
+        c.add("guest", "pass", 2)
+        c.invalidate("1")
+        self.assertEqual(c.get("admin", "pass"), None)
+        self.assertEqual(c.get("guest", "pass"), 2)
+
+    def test_max_entries(self):
+        c = self.cache
+        c.MAX_ENTRIES = 2
+        c.add("a", "1", 1)
+        self.now += 301
+        c.add("b", "1", 2)
+        c.add("c", "1", 3)
+        self.assertEqual(len(c.entries), 2)
+        self.assertEqual(c.get("c", "1"), 3)
+
+    def test_touch(self):
+        c = self.cache
+        self.assertTrue(c.should_touch(1))
+        self.assertFalse(c.should_touch(1))
+        self.assertTrue(c.should_touch(2))
+        self.now += 61
+        self.assertTrue(c.should_touch(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest
+
+from webserver.ranking import CounterBuffer, HotRanking
+
+
+class FakeCache:
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def all_book_ids(self):
+        return frozenset(self.ids)
+
+
+class TestHotRanking(unittest.TestCase):
+    def setUp(self):
+        self.day = 1000
+        self.cache = FakeCache(range(1, 10))
+        self.ranking = HotRanking(self.cache, clock=lambda: self.day)
+
+    def test_all_time(self):
+        r = self.ranking
+        r.increase(1, visit=1)
+        self.assertEqual(r.top("all"), [])  # 访问超过1次才上全站榜
+        r.increase(1, visit=1)
+        r.increase(2, visit=2, download=1)
+        r.increase(3, visit=2)
+        self.assertEqual(r.top("all"), [2, 3, 1])
+        version = r.version
+        r.increase(2, download=1)
+        self.assertEqual(r.version, version)  # 顺序没有变化
+        r.increase(1, download=2)
+        self.assertEqual(r.top("all"), [2, 1, 3])
+        self.assertTrue(r.version > version)
+        self.assertEqual(r.ranked("all"), [(6, 2), (6, 1), (4, 3)])
+
+    def test_windows(self):
+        r = self.ranking
+        r.increase(1, visit=3)
+        self.day += 1
+        r.increase(2, visit=1)
+        self.assertEqual(r.top("day"), [2])
+        self.assertEqual(r.top("week"), [1, 2])
+        self.day += 6
+        self.assertEqual(r.top("day"), [])
+        self.assertEqual(r.top("week"), [2])
+        self.assertEqual(r.top("all"), [1])
+        self.assertEqual(sorted(r.daily.keys()), [1001])
+
+    def test_top_n(self):
+        r = self.ranking
+        r.TOP_N = 3
+        for i in range(1, 6):
+            r.increase(i, download=i)
+        self.assertEqual(r.top("day"), [5, 4, 3])
+        r.increase(1, download=10)
+        self.assertEqual(r.top("day"), [1, 5, 4])
+
+    def test_removed(self):
+        r = self.ranking
+        r.increase(1, visit=2)
+        r.increase(2, visit=3)
+        self.cache.ids.discard(2)
+        r.on_library_changed([2])
+        self.assertEqual(r.top("all"), [1])
+        self.assertEqual(r.top("week"), [1])
+        self.cache.ids.discard(1)
+        r.on_library_changed(None)
+        self.assertEqual(r.top("day"), [])
+
+
+class FakeCounterBuffer(CounterBuffer):
+    def __init__(self, **kwargs):
+        super(FakeCounterBuffer, self).__init__(None, clock=lambda: 1000, **kwargs)
+        self.written = []
+        self.fail = False
+
+    def write(self, items, daily, totals):
+        if self.fail:
+            raise RuntimeError("db locked")
+        self.written.append((items, daily, totals))
+
+
+class TestCounterBuffer(unittest.TestCase):
+    def test_pending(self):
+        c = FakeCounterBuffer()
+        c.add(1, visit=1)
+        c.add("1", guest=1, visit=1)
+        c.add(2, download=1)
+        self.assertEqual(c.pending(1), {"count_guest": 1, "count_visit": 2, "count_download": 0})
+        self.assertEqual(c.pending(3), {})
+        self.assertEqual(c.pending_total("visit"), 2)
+        self.assertEqual(c.written, [])
+
+        c.flush()
+        self.assertEqual(len(c.written), 1)
+        items, daily, totals = c.written[0]
+        self.assertEqual(items, {1: [1, 2, 0], 2: [0, 0, 1]})
+        self.assertEqual(daily, {(1, 1000): 4, (2, 1000): 1})
+        self.assertEqual(totals, {"visit": 2, "download": 1})
+        self.assertEqual(c.flushed, {"visit": 2, "download": 1})
+        self.assertEqual(c.pending(1), {})
+        self.assertEqual(c.pending_total("visit"), 0)
+
+        c.flush()
+        self.assertEqual(len(c.written), 1)
+
+    def test_max_events(self):
+        c = FakeCounterBuffer(max_events=3)
+        c.add(1, visit=1)
+        c.add(1, visit=1)
+        self.assertEqual(c.written, [])
+        c.add(1, visit=1)
+        self.assertEqual(len(c.written), 1)
+
+    def test_retry(self):
+        c = FakeCounterBuffer()
+        c.add(1, visit=1)
+        c.fail = True
+        c.flush()
+        c.add(1, download=1)
+        self.assertEqual(c.pending(1), {"count_guest": 0, "count_visit": 1, "count_download": 1})
+        c.fail = False
+        c.flush()
+        self.assertEqual(c.written[0][0], {1: [0, 1, 1]})
+        self.assertEqual(c.written[0][1], {(1, 1000): 3})
+
+    def test_discard(self):
+        c = FakeCounterBuffer()
+        c.add(1, visit=1)
+        c.add(2, visit=1)
+        c.discard(1)
+        c.flush()
+        self.assertEqual(c.written[0][0], {2: [0, 1, 0]})
+        self.assertEqual(c.written[0][1], {(2, 1000): 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+import unittest
+from unittest import mock
+
+from webserver.search import SearchIndex, SuggestIndex, tokenize
+
+PINYIN = {
+    "百": "bai", "年": "nian", "孤": "gu", "独": "du", "老": "lao", "人": "ren", "与": "yu", "海": "hai",
+    "明": "ming", "威": "wei", "小": "xiao", "说": "shuo", "红": "hong", "楼": "lou", "梦": "meng",
+}
+
+
+class FakeCache:
+    def __init__(self, books):
+        self.books = books
+
+    def all_book_ids(self):
+        return frozenset(self.books)
+
+    def all_field_for(self, field, book_ids):
+        return dict((i, self.books[i].get(field)) for i in book_ids if i in self.books)
+
+    def all_field_names(self, field):
+        names = set()
+        for b in self.books.values():
+            val = b.get(field)
+            names.update(val if isinstance(val, tuple) else [val] if val else [])
+        return names
+
+
+class NoIter(list):
+    def __iter__(self):
+        raise AssertionError("full vocabulary scan")
+
+
+BOOKS = {
+    1: {"title": "百年孤独", "authors": ("加西亚·马尔克斯",), "tags": ("小说", "魔幻现实主义"), "series": None},
+    2: {"title": "The Old Man and the Sea", "authors": ("Ernest Hemingway",), "tags": ("Novel",), "series": None},
+    3: {"title": "老人与海", "authors": ("海明威",), "tags": ("小说", "美国"), "series": "译文经典"},
+    4: {"title": "Sea of Tranquility", "authors": ("Emily St. John Mandel",), "tags": (), "series": "Old Stories"},
+}
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeCache(dict((k, dict(v)) for k, v in BOOKS.items()))
+        self.index = SearchIndex(self.cache, pinyin=lambda c: PINYIN.get(c, ""))
+        self.index.build()
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("红楼梦(Dream of_the Red)第1卷"), ["红楼梦", "dream", "of", "the", "red", "第", "1", "卷"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_search_fields(self):
+        self.assertEqual(self.index.search("小说"), [3, 1])
+        self.assertEqual(self.index.search("海明威"), [3])
+        self.assertEqual(self.index.search("译文"), [3])
+        self.assertEqual(self.index.search("NotFound"), [])
+        self.assertEqual(self.index.search("  "), [])
+        self.assertEqual(self.index.search_scores("  "), {})
+        self.assertEqual(sorted(self.index.search_scores("小说").keys()), [1, 3])
+
+    def test_relevance(self):
+        # 书名命中优先于丛书命中，完整匹配优先于部分匹配
+        self.assertEqual(self.index.search("old"), [2, 4])
+        self.assertEqual(self.index.search("sea"), [4, 2])
+        self.assertEqual(self.index.search("se"), [4, 2])
+
+    def test_contains(self):
+        self.assertEqual(self.index.search("孤独"), [1])
+        self.assertEqual(self.index.search("ming"), [2])
+        self.assertEqual(self.index.search("anquil"), [4])
+        # 两个字母以内只做前缀匹配
+        self.assertEqual(self.index.search("ld"), [])
+
+    def test_no_scan(self):
+        # 查询只能通过倒排表和有序词表的二分查找完成，不能遍历整个词表
+        self.index.tokens = NoIter(self.index.tokens)
+        self.index.pinyin_list = NoIter(self.index.pinyin_list)
+        self.assertEqual(self.index.search("ming"), [2])
+        self.assertEqual(self.index.search("old sea"), [2, 4])
+        self.assertEqual(self.index.search("bngd", mode="pinyin"), [1])
+        self.assertEqual(self.index.search("minghem", mode="pinyin"), [])
+
+    def test_cjk(self):
+        self.assertEqual(self.index.search("海"), [3])
+        self.assertEqual(self.index.search("人与"), [3])
+        self.assertEqual(self.index.search("与人"), [])
+        self.assertEqual(self.index.search("说小"), [])
+
+    def test_pinyin(self):
+        self.assertEqual(self.index.search("bngd"), [])
+        self.assertEqual(self.index.search("bngd", mode="pinyin"), [1])
+        self.assertEqual(self.index.search("bainian", mode="pinyin"), [1])
+        self.assertEqual(self.index.search("gudu", mode="pinyin"), [1])
+        self.assertEqual(self.index.search("hmw", mode="pinyin"), [3])
+        self.assertEqual(self.index.search("lao", mode="pinyin"), [3])
+        self.assertEqual(self.index.search("hai", mode="pinyin"), [3])
+
+        self.cache.books[5] = {"title": "红楼梦", "authors": ("曹雪芹",), "tags": (), "series": None}
+        self.index.on_library_changed([5])
+        self.assertEqual(self.index.search("hlm", mode="pinyin"), [5])
+        del self.cache.books[5]
+        self.index.on_library_changed([5])
+        self.assertEqual(self.index.search("hlm", mode="pinyin"), [])
+        self.assertTrue("hlm" not in self.index.pinyin_list)
+        self.assertTrue("红楼" not in self.index.grams)
+
+    def test_multi_words(self):
+        self.assertEqual(self.index.search("old sea"), [2, 4])
+        self.assertEqual(self.index.search("old 小说"), [])
+
+    def test_update(self):
+        self.cache.books[5] = {"title": "Old Times", "authors": ("X",), "tags": (), "series": None}
+        self.index.on_library_changed([5])
+        self.assertEqual(self.index.search("times"), [5])
+
+        self.cache.books[2]["title"] = "Farewell"
+        self.index.on_library_changed([2])
+        self.assertEqual(self.index.search("old"), [5, 4])
+
+        del self.cache.books[5]
+        self.index.on_library_changed([5])
+        self.assertEqual(self.index.search("times"), [])
+        self.assertTrue("times" not in self.index.tokens)
+        self.assertTrue("ime" not in self.index.grams)
+
+        self.cache.books[4]["series"] = None
+        self.index.on_library_changed(None)
+        self.assertEqual(self.index.search("old"), [])
+
+
+    def test_build_without_lock(self):
+        # 重建期间读取书库和分词不占用锁，查询可以继续使用旧的索引
+        read_books = self.index.read_books
+        found = []
+
+        def slow_read(book_ids):
+            # 在其他线程中查询（RLock在同一线程中可以重入）
+            t = threading.Thread(target=lambda: found.append(self.index.search("old")))
+            t.start()
+            t.join(1)
+            return read_books(book_ids)
+
+        with mock.patch.object(SearchIndex, "read_books", side_effect=slow_read):
+            self.cache.books[2]["title"] = "Farewell"
+            self.index.build()
+        self.assertEqual(found, [[2, 4]])
+        self.assertEqual(self.index.search("old"), [4])
+
+
+class TestSuggestIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache = FakeCache(dict((k, dict(v)) for k, v in BOOKS.items()))
+        self.index = SuggestIndex(self.cache, pinyin=lambda c: PINYIN.get(c, ""))
+        self.index.build()
+
+    def names(self, q, **kwargs):
+        return [(v["type"], v["name"]) for v in self.index.suggest(q, **kwargs)]
+
+    def test_prefix(self):
+        self.assertEqual(self.names("老"), [("title", "老人与海")])
+        self.assertEqual(self.names("海明"), [("author", "海明威")])
+        self.assertEqual(self.names("old"), [("series", "Old Stories")])
+        # 同类型中较短的名字排在前面
+        self.assertEqual(self.names("e"), [("author", "Ernest Hemingway"), ("author", "Emily St. John Mandel")])
+        self.assertEqual(self.names("e", limit=1), [("author", "Ernest Hemingway")])
+        self.assertEqual(self.names("xyz"), [])
+        self.assertEqual(self.names(" "), [])
+
+    def test_pinyin(self):
+        self.assertEqual(self.names("bngd"), [("title", "百年孤独")])
+        self.assertEqual(self.names("xiaos"), [("tag", "小说")])
+        # 仅部分汉字有拼音时，不生成拼音提示
+        self.assertEqual(self.names("hm"), [("author", "海明威")])
+
+    def test_update(self):
+        self.cache.books[5] = {"title": "红楼梦", "authors": ("曹雪芹",), "tags": ("小说",), "series": None}
+        self.index.update([5])
+        self.assertEqual(self.names("hlm"), [("title", "红楼梦")])
+        self.assertEqual(self.names("曹"), [("author", "曹雪芹")])
+
+        # 修改书名后，旧书名不再提示；其他书籍仍在使用的标签保留
+        self.cache.books[5]["title"] = "石头记"
+        self.cache.books[5]["tags"] = ()
+        self.index.on_library_changed([5])
+        self.assertEqual(self.names("hlm"), [])
+        self.assertEqual(self.names("石头"), [("title", "石头记")])
+        self.assertEqual(self.names("小说"), [("tag", "小说")])
+
+        del self.cache.books[5]
+        del self.cache.books[3]
+        self.index.build = None  # 删除书籍时不能重建
+        self.index.on_library_changed([5, 3])
+        self.assertEqual(self.names("曹"), [])
+        self.assertEqual(self.names("海明"), [])
+        self.assertEqual(self.names("小说"), [("tag", "小说")])
+        self.assertEqual(self.index.refs[("小说", 3, "小说", "tag")], 1)
+
+        del self.cache.books[1]
+        self.index.on_library_changed([1])
+        self.assertEqual(self.names("小说"), [])
+        self.assertEqual(len(self.index.entries), len(self.index.refs))
+
+if __name__ == "__main__":
+    unittest.main()
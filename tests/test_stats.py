@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import unittest
+
+from tests.test_ranking import FakeCounterBuffer
+from webserver.stats import SiteStats
+
+
+class FakeDB:
+    def __init__(self):
+        self.books = 3
+        self.calls = 0
+
+    def count(self):
+        self.calls += 1
+        return self.books
+
+    def all_tags(self):
+        return ["a", "b"]
+
+    def all_authors(self):
+        return [(1, "x")]
+
+    def all_publishers(self):
+        return []
+
+    def all_series(self):
+        return []
+
+    def last_modified(self):
+        return datetime.datetime(2022, 1, 2)
+
+
+class FakeSiteStats(SiteStats):
+    def __init__(self, db, counters):
+        super(FakeSiteStats, self).__init__(db, None, counters)
+        self.rows = {"users": 5, "active": 2, "visit": 100, "download": 10}
+        self.loads = 0
+
+    def load_users(self):
+        self.loads += 1
+        return dict(self.rows)
+
+
+class TestSiteStats(unittest.TestCase):
+    def test_get(self):
+        db = FakeDB()
+        counters = FakeCounterBuffer()
+        stats = FakeSiteStats(db, counters)
+        d = stats.get()
+        self.assertEqual(d["books"], 3)
+        self.assertEqual(d["tags"], 2)
+        self.assertEqual(d["mtime"], "2022-01-02")
+        self.assertEqual((d["users"], d["active"], d["readcount"], d["downloadcount"]), (5, 2, 100, 10))
+
+        stats.get()
+        self.assertEqual((db.calls, stats.loads), (1, 1))
+
+        db.books = 4
+        stats.on_library_changed([4])
+        self.assertEqual(stats.get()["books"], 4)
+
+    def test_counters(self):
+        counters = FakeCounterBuffer()
+        stats = FakeSiteStats(FakeDB(), counters)
+        counters.add(1, visit=1)
+        self.assertEqual(stats.get()["readcount"], 101)
+
+        # 写入数据库之后，定时刷新之前，访问量不能变少或者重复计算
+        counters.flush()
+        stats.rows["visit"] = 101
+        self.assertEqual(stats.get()["readcount"], 101)
+        stats.refresh()
+        self.assertEqual(stats.get()["readcount"], 101)
+        counters.add(1, download=2)
+        self.assertEqual(stats.get()["downloadcount"], 12)
+
+    def test_changed_while_loading(self):
+        db = FakeDB()
+        stats = FakeSiteStats(db, FakeCounterBuffer())
+        count = db.count
+
+        def slow_count():
+            n = count()
+            db.books = 5
+            stats.on_library_changed([5])
+            return n
+
+        db.count = slow_count
+        self.assertEqual(stats.get()["books"], 3)
+        self.assertEqual(stats.library, None)
+        db.count = count
+        self.assertEqual(stats.get()["books"], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from webserver.thumbnails import ThumbnailCache, negotiate_format, sprite_layout
+
+
+class FakeCoverCache:
+    def __init__(self):
+        self.covers = {1: (b"cover1", 100), 2: (b"cover2", 100)}
+
+    def cover_last_modified(self, book_id):
+        if book_id not in self.covers:
+            return None
+        return datetime.datetime.fromtimestamp(self.covers[book_id][1], datetime.timezone.utc)
+
+    def cover(self, book_id):
+        return self.covers[book_id][0] if book_id in self.covers else None
+
+
+def fake_thumbnail(cover, width, height, fmt="jpg"):
+    return b"%s-%dx%d" % (cover, width, height)
+
+
+@mock.patch("webserver.thumbnails.make_thumbnail", side_effect=fake_thumbnail)
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = FakeCoverCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make(self, **kwargs):
+        t = ThumbnailCache(self.cache, self.path, b"default", 10, **kwargs)
+        t.load()
+        return t
+
+    def test_get(self, render):
+        t = self.make()
+        self.assertEqual(t.get(1, 60, 80), b"cover1-60x80")
+        self.assertEqual(t.get(1, 60, 80), b"cover1-60x80")
+        self.assertEqual(render.call_count, 1)
+
+        # 封面更新后，使用新的缓存文件
+        self.cache.covers[1] = (b"new1", 200)
+        self.assertEqual(t.get(1, 60, 80), b"new1-60x80")
+        self.assertEqual(render.call_count, 2)
+
+        # 没有封面的书籍共用默认封面的缩略图
+        self.assertEqual(t.get(3, 60, 80), b"default-60x80")
+        self.assertEqual(t.get(4, 60, 80), b"default-60x80")
+        self.assertEqual(render.call_count, 3)
+
+        # 重启后从磁盘恢复
+        t = self.make()
+        self.assertEqual(len(t.files), 3)
+        self.assertEqual(t.get(1, 60, 80), b"new1-60x80")
+        self.assertEqual(render.call_count, 3)
+
+    def test_evict(self, render):
+        t = self.make(max_bytes=30)
+        t.get(1, 60, 80)
+        t.get(2, 60, 80)
+        t.get(1, 60, 80)  # 最近使用
+        t.get(1, 100, 100)
+        self.assertEqual(t.total, 26)
+        names = list(t.files)
+        self.assertEqual(len(names), 2)
+        files = [f for d in os.listdir(self.path) for f in os.listdir(os.path.join(self.path, d))]
+        self.assertEqual(sorted(files), sorted(names))
+        self.assertEqual(t.get(2, 60, 80), b"cover2-60x80")
+        self.assertEqual(render.call_count, 4)
+
+    def test_disabled(self, render):
+        t = ThumbnailCache(self.cache, os.path.join(self.path, "file"), b"default", 10)
+        with open(os.path.join(self.path, "file"), "w") as f:
+            f.write("not a dir")
+        t.load()
+        self.assertEqual(t.get(1, 60, 80), b"cover1-60x80")
+        self.assertEqual(t.get(1, 60, 80), b"cover1-60x80")
+        self.assertEqual(render.call_count, 2)
+
+    def test_pregenerate(self, render):
+        t = self.make(sizes=[(60, 80), (120, 160)])
+        t.pregenerate([1, 2])
+        self.assertEqual(render.call_count, 4)
+        t.get(2, 120, 160)
+        self.assertEqual(render.call_count, 4)
+
+        # 书库变化时由同一个后台线程生成
+        t.on_library_changed([3])
+        t.on_library_changed([4])
+        t.pending.join()
+        worker = t.worker
+        self.assertEqual(render.call_count, 6)  # 3、4都使用默认封面
+        t.on_library_changed([1])
+        t.pending.join()
+        self.assertTrue(t.worker is worker)
+
+    def test_restart_order(self, render):
+        t = self.make()
+        t.get(1, 60, 80)
+        t.get(2, 60, 80)
+        first, second = [t.file_path(name) for name in t.files]
+        os.utime(first, (100, 100))
+        os.utime(second, (200, 200))
+        t.get(1, 60, 80)  # 命中后更新修改时间
+        t = self.make()
+        self.assertEqual([t.file_path(name) for name in t.files], [second, first])
+
+        # 最近更新过的文件，命中时不再修改
+        now = time.time() - 60
+        os.utime(second, (now, now))
+        t.get(2, 60, 80)
+        self.assertEqual(os.stat(second).st_mtime, now)
+
+    def test_sprite(self, render):
+        t = self.make()
+        name = t.sprite_name([1, 3], 60, 80)
+        self.assertEqual(name, t.sprite_name([1, 3], 60, 80))
+        self.assertNotEqual(name, t.sprite_name([3, 1], 60, 80))
+        self.assertTrue(t.sprite_name([1, 3], 60, 80, "webp").endswith(".webp"))
+
+        join = lambda thumbs, w, h, fmt: b"|".join(thumbs)  # noqa: E731
+        with mock.patch("webserver.thumbnails.make_sprite", side_effect=join) as sprite:
+            self.assertEqual(t.get_sprite(name, [1, 3], 60, 80), b"cover1-60x80|default-60x80")
+            self.assertEqual(t.get_sprite(name, [1, 3], 60, 80), b"cover1-60x80|default-60x80")
+            self.assertEqual((sprite.call_count, render.call_count), (1, 2))
+
+            # 封面更新后名字变化，未变化的缩略图仍从磁盘缓存读取
+            self.cache.covers[1] = (b"new1", 200)
+            new_name = t.sprite_name([1, 3], 60, 80)
+            self.assertNotEqual(name, new_name)
+            self.assertEqual(t.get_sprite(new_name, [1, 3], 60, 80), b"new1-60x80|default-60x80")
+            self.assertEqual((sprite.call_count, render.call_count), (2, 3))
+
+    def test_sprite_layout(self, render):
+        self.assertEqual(sprite_layout(1), (1, 1))
+        self.assertEqual(sprite_layout(10), (10, 1))
+        self.assertEqual(sprite_layout(11), (10, 2))
+        self.assertEqual(sprite_layout(60), (10, 6))
+
+
+class TestNegotiateFormat(unittest.TestCase):
+    @mock.patch("webserver.thumbnails.writable_formats", return_value={"jpg", "webp"})
+    def test_negotiate(self, formats):
+        chrome = "image/avif,image/webp,image/apng,image/*,*/*;q=0.8"
+        self.assertEqual(negotiate_format(chrome, ["avif", "webp"]), "webp")
+        self.assertEqual(negotiate_format(chrome, []), "jpg")
+        self.assertEqual(negotiate_format("image/*", ["avif", "webp"]), "jpg")
+        formats.return_value = {"jpg", "webp", "avif"}
+        self.assertEqual(negotiate_format(chrome, ["avif", "webp"]), "avif")
+        self.assertEqual(negotiate_format(chrome, ["webp", "avif"]), "webp")
+        self.assertEqual(negotiate_format("image/avif;q=0, image/webp", ["avif", "webp"]), "webp")
+        self.assertEqual(negotiate_format("image/webp; q=0.0,image/*", ["webp"]), "jpg")
+        self.assertEqual(negotiate_format("image/webp;q=0.5", ["webp"]), "webp")
+        self.assertEqual(negotiate_format("image/webp;q=x", ["webp"]), "jpg")
+
+    def test_not_probed(self):
+        # 启动时没有检查过编码器，只使用jpg
+        with mock.patch("webserver.thumbnails._writable_formats", None):
+            self.assertEqual(negotiate_format("image/webp", ["webp"]), "jpg")
+
+    def test_full_size(self):
+        with mock.patch("webserver.thumbnails.make_thumbnail", side_effect=fake_thumbnail) as render:
+            t = ThumbnailCache(FakeCoverCache(), "/nonexistent", b"default", 10)
+            self.assertEqual(t.get(1, 0, 0, "webp"), b"cover1-0x0")
+            render.assert_called_with(b"cover1", 0, 0, "webp")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,7 +17,7 @@ import tornado
 
 from webserver import loader, utils
 from webserver.handlers.base import BaseHandler, auth, js, is_admin
-from webserver.models import Reader
+from webserver.models import Reader, ReaderHistory
 from webserver.plugins.meta import baike, douban
 from webserver.utils import SimpleBookFormatter, check_email
 
@@ -57,6 +57,7 @@ class AdminUsers(BaseHandler):
             all_users = query.offset(start).all()
         else:
             all_users = query.limit(num).offset(start).all()
+        history = utils.count_user_his(self.session, [user.id for user in all_users])
         for user in all_users:
             d = {
                 "id": user.id,
@@ -67,6 +68,7 @@ class AdminUsers(BaseHandler):
                 "is_active": user.is_active(),
                 "is_admin": user.is_admin(),
                 "extra": dict(user.extra),
+                "history": history.get(user.id, {}),
                 "provider":
                     user.social_auth[0].provider
                     if hasattr(user, "social_auth") and user.social_auth.count()
@@ -109,8 +111,11 @@ class AdminUsers(BaseHandler):
             if self.user_id() == user.id:
                 return {"err": "params.user.invalid", "msg": _("不允许删除自己")}
 
+            self.session.query(ReaderHistory).filter(ReaderHistory.reader_id == user.id).delete()
             self.session.query(Reader).filter(Reader.id == user.id).delete()
             self.session.commit()
+            self.principals.invalidate(user.id)
+            self.credentials.invalidate(user.id)
             return {"err": "ok", "msg": _("删除成功")}
 
         p = data.get("permission", "")
@@ -123,6 +128,8 @@ class AdminUsers(BaseHandler):
         except Exception as e:
             self.session.rollback()
             logging.warning("some err: %r" % e)
+        self.principals.invalidate(user.id)
+        self.credentials.invalidate(user.id)
         return {"err": "ok"}
 
 
@@ -228,7 +235,9 @@ class AdminSettings(BaseHandler):
                 "link": "https://developers.weixin.qq.com/doc/offiaccount/OA_Web_Apps/Wechat_webpage_authorization.html",
             },
         ]
-        return {"err": "ok", "settings": CONF, "sns": sns, "site_url": self.site_url}
+        # 内存缓存的命中情况，便于管理员评估缓存容量是否合适
+        caches = {"formatted_books": self.formatted_books.stats()}
+        return {"err": "ok", "settings": CONF, "sns": sns, "site_url": self.site_url, "caches": caches}
 
     @js
     @auth
@@ -256,6 +265,7 @@ class AdminSettings(BaseHandler):
             "scan_upload_path",
             "RESTRICT_DOWNLOADS_COUNT_PER_IP",
             "downloads_count_per_ip_limitation",
+            "downloads_count_per_user_limitation",
             "douban_apikey",
             "douban_baseurl",
             "douban_max_count",
@@ -340,6 +350,8 @@ class AdminInstall(BaseHandler):
             self.session.rollback()
             logging.error(traceback.format_exc())
             return {"err": "db.error", "msg": _(u"系统异常，请重试或更换注册信息")}
+        self.principals.invalidate(user.id)
+        self.credentials.invalidate(user.id)
 
         args = loader.SettingsLoader()
         args.clear()
@@ -488,31 +500,34 @@ class AdminBookList(BaseHandler):
 
         all_ids = []
         if search:
-            id_set = set()
-            for i in ["title", "author", "tag", "series"]:
-                ids_tmp = self.cache.search("%s:%s" % (i, search))
-                for id in ids_tmp:
-                    if id not in id_set:
-                        id_set.add(id)
-                        all_ids.append(id)
+            all_ids = self.search_index.search(search)
+            if sort == "id":
+                all_ids.sort(reverse=desc)
+        elif sort == "id":
+            all_ids = self.book_ids.ids if desc else self.book_ids.ascending
         else:
-            if sort != "id":
-                self.db.sort(field=sort, ascending=(not desc))
+            self.db.sort(field=sort, ascending=(not desc))
             all_ids = self.search_for_books("")
 
-        if sort == "id":
-            all_ids.sort(reverse=desc)
-
         total = len(all_ids)
 
+        # 按ID排序时，支持after游标分页
+        next_cursor = ""
+        if sort == "id":
+            key_at = lambda i: (all_ids[i],)  # noqa: E731
+            if self.get_argument("after", ""):
+                start = self.get_page_start(all_ids, key_at, reverse=desc)
+                end = start + num
+            next_cursor = self.get_next_cursor(all_ids, end, key_at)
+
         books = []
-        page_ids = all_ids[start:end]
+        page_ids = list(all_ids[start:end])
         if page_ids:
             books = [SimpleBookFormatter(b, self.cdn_url).format() for b in self.get_books(ids=page_ids)]
             if sort == "id":
                 books.sort(key=lambda x: x["id"], reverse=desc)
 
-        return {"err": "ok", "items": books, "total": total}
+        return {"err": "ok", "items": books, "total": total, "next": next_cursor}
 
     @js
     @is_admin
@@ -547,6 +562,7 @@ class AdminBookList(BaseHandler):
                         changed = True
             if changed:
                 self.db.set_metadata(id, mi)
+                self.formatted_books.invalidate(id)
         return {"err": "ok", "msg": _(u"任务执行完成！")}
 
     def do_detect(self, book_list, background_task):
@@ -568,6 +584,7 @@ class AdminBookList(BaseHandler):
             for id in book_list:
                 try:
                     detect_one(self.db, new_session, id, api)
+                    self.formatted_books.invalidate(id)
                 except Exception as e:
                     logging.info("some err when detect book: %d, err: %r" % (id, e))
                     continue
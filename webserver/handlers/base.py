@@ -4,6 +4,7 @@
 
 import base64
 import datetime
+import email.utils
 import hashlib
 import json
 import logging
@@ -14,12 +15,12 @@ from collections import defaultdict
 from gettext import gettext as _
 
 from jinja2 import Environment, FileSystemLoader
-from sqlalchemy import func as sql_func
 from tornado import web
 
 from webserver import loader, utils, constants
+from webserver.library import decode_cursor, encode_cursor, seek
 # import social_tornado.handlers
-from webserver.models import Item, Message, Reader, IpDownloads, KeyValueStore
+from webserver.models import Item, Message, Reader
 from webserver.plugins.meta import baike, douban
 from webserver.utils import filter_tags
 
@@ -48,11 +49,18 @@ def website_format(value):
     return ";".join(links)
 
 
+class NotModified(Exception):
+    """客户端缓存的数据仍然有效，由js装饰器返回304"""
+
+
 def js(func):
     def do(self, *args, **kwargs):
+        not_modified = False
         try:
             rsp = func(self, *args, **kwargs)
             rsp["msg"] = rsp.get("msg", "")
+        except NotModified:
+            rsp, not_modified = None, True
         except Exception as e:
             import traceback
             msg = (
@@ -69,7 +77,10 @@ def js(func):
         self.set_header("Access-Control-Allow-Origin", origin)
         self.set_header("Access-Control-Allow-Credentials", "true")
         self.set_header("Cache-Control", "max-age=0")
-        self.write(rsp)
+        if not_modified:
+            self.set_status(304)
+        else:
+            self.write(rsp)
         self.finish()
         return
 
@@ -78,7 +89,7 @@ def js(func):
 
 def auth(func):
     def do(self, *args, **kwargs):
-        if not self.current_user:
+        if not self.principal:
             return {"err": "user.need_login", "msg": _(u"请先登录")}
         return func(self, *args, **kwargs)
 
@@ -87,7 +98,7 @@ def auth(func):
 
 def is_admin(func):
     def do(self, *args, **kwargs):
-        if not self.current_user:
+        if not self.principal:
             return {"err": "user.need_login", "msg": _(u"请先登录")}
         if not self.admin_user:
             return {"err": "permission.not_admin", "msg": _(u"当前用户非管理员")}
@@ -98,6 +109,8 @@ def is_admin(func):
 
 class BaseHandler(web.RequestHandler):
     _path_to_env = {}
+    LOGIN_EXPIRE_DAYS = 30
+    LOGIN_REFRESH_DAYS = 7  # 登录有效期不足7天时，刷新登录时间
 
     def get_secure_cookie(self, key):
         if not self.cookies_cache.get(key, ""):
@@ -132,13 +145,26 @@ class BaseHandler(web.RequestHandler):
             return False
         auth_decoded = base64.decodebytes(auth_header[6:].encode("ascii")).decode("UTF-8")
         username, password = auth_decoded.split(":", 2)
-        user = self.session.query(Reader).filter(Reader.username == username).first()
-        if not user:
-            return False
-        if user.get_secure_password(password) != str(user.password):
-            return False
+        user = None
+        user_id = self.credentials.get(username, password)
+        if user_id is None:
+            user = self.session.query(Reader).filter(Reader.username == username).first()
+            if not user:
+                return False
+            if user.get_secure_password(password) != str(user.password):
+                return False
+            self.credentials.add(username, password, user.id)
+            user_id = user.id
         self.mark_invited()
-        self.login_user(user)
+        # 客户端每个请求都会认证，登录时间和IP每隔一段时间才写入一次数据库
+        if self.credentials.should_touch(user_id):
+            user = user or self.session.query(Reader).get(user_id)
+            if not user:
+                return False
+            self.login_user(user)
+        else:
+            self.set_secure_cookie("user_id", str(user_id))
+            self.set_secure_cookie("lt", str(int(time.time())))
         return True
 
     def send_error_of_not_invited(self):
@@ -194,6 +220,21 @@ class BaseHandler(web.RequestHandler):
         self.session = ScopedSession()  # new sql session
         self.db = self.settings["legacy"]
         self.cache = self.db.new_api
+        self.watcher = self.settings["watcher"]
+        self.book_ids = self.settings["book_ids"]
+        self.search_index = self.settings["search_index"]
+        self.suggest_index = self.settings["suggest_index"]
+        self.hot_ranking = self.settings["hot_ranking"]
+        self.category_books = self.settings["category_books"]
+        self.category_counts = self.settings["category_counts"]
+        self.formatted_books = self.settings["formatted_books"]
+        self.format_sizes = self.settings["format_sizes"]
+        self.counters = self.settings["counters"]
+        self.download_limiter = self.settings["download_limiter"]
+        self.site_stats = self.settings["site_stats"]
+        self.principals = self.settings["principals"]
+        self.credentials = self.settings["credentials"]
+        self.thumbnails = self.settings["thumbnails"]
         self.build_time = self.settings["build_time"]
         self.default_cover = self.settings["default_cover"]
         self.admin_user = None
@@ -213,34 +254,60 @@ class BaseHandler(web.RequestHandler):
 
     def user_id(self):
         login_time = self.get_secure_cookie("lt")
-        if not login_time or int(login_time) < int(time.time()) - 30 * 86400:
+        if not login_time or int(login_time) < int(time.time()) - self.LOGIN_EXPIRE_DAYS * 86400:
             return None
         uid = self.get_secure_cookie("user_id")
-        # 30天内登录，则自动延长登录时间。
-        self.set_secure_cookie("lt", str(int(time.time())))
-        self.set_secure_cookie("user_id", uid)
+        # 登录未过期时自动延长登录时间；只在快过期时刷新，避免每个请求都重新签名并下发cookie
+        if int(login_time) < int(time.time()) - (self.LOGIN_EXPIRE_DAYS - self.LOGIN_REFRESH_DAYS) * 86400:
+            self.set_secure_cookie("lt", str(int(time.time())))
+            self.set_secure_cookie("user_id", uid)
         return int(uid) if uid.isdigit() else None
 
-    def get_current_user(self):
-        user_id = self.user_id()
-        if user_id:
-            user_id = int(user_id)
-        user = self.session.query(Reader).get(user_id) if user_id else None
-        # logging.debug("Query User(%s) = %s" % (user_id, user))
+    def check_not_modified(self, *args, etag=None, mtime=None):
+        """客户端缓存仍有效时抛出NotModified，跳过后续的查询
+
+        etag为None时，根据书库版本号、当前用户以及额外参数生成；
+        mtime为内容的修改时间戳，设置后同时支持Last-Modified和If-Modified-Since"""
+        if etag is None:
+            parts = [self.watcher.boot, self.watcher.version, self.user_id(), self.get_secure_cookie("admin_id")]
+            parts += [self.cdn_url, self.api_url, self.request.uri] + list(args)
+            etag = hashlib.md5("|".join(str(v) for v in parts).encode("UTF-8")).hexdigest()
+        self.set_header("Etag", '"%s"' % etag)
+        if mtime is not None:
+            mtime = int(mtime)
+            self.set_header("Last-Modified", self.last_modified(datetime.datetime.utcfromtimestamp(mtime)))
+
+        # 同时带有两者时，以If-None-Match为准
+        if self.request.headers.get("If-None-Match"):
+            not_modified = self.check_etag_header()
+        else:
+            since = self.request.headers.get("If-Modified-Since")
+            date_tuple = email.utils.parsedate_tz(since) if since and mtime is not None else None
+            not_modified = date_tuple is not None and email.utils.mktime_tz(date_tuple) >= mtime
+        if not_modified:
+            raise NotModified()
+
+    @property
+    def principal(self):
+        """当前用户的权限信息，用于登录和权限检查；需要完整的用户数据时再使用current_user"""
+        if not hasattr(self, "_principal"):
+            user_id = self.user_id()
+            self._principal = self.principals.get(self.session, user_id) if user_id else None
+            admin_id = self.get_secure_cookie("admin_id")
+            if admin_id:
+                self.admin_user = self.principals.get(self.session, int(admin_id))
+            elif self._principal and self._principal.is_admin():
+                self.admin_user = self._principal
+        return self._principal
 
-        admin_id = self.get_secure_cookie("admin_id")
-        if admin_id:
-            self.admin_user = self.session.query(Reader).get(int(admin_id))
-        elif user and user.is_admin():
-            self.admin_user = user
-        return user
+    def get_current_user(self):
+        principal = self.principal
+        return self.session.query(Reader).get(principal.id) if principal else None
 
     def is_admin(self):
-        if self.admin_user:
-            return True
-        if not self.current_user:
+        if not self.principal:
             return False
-        return self.current_user.is_admin()
+        return bool(self.admin_user) or self.principal.is_admin()
 
     def login_user(self, user):
         logging.info("LOGIN: %s - %d - %s" % (self.request.remote_ip, user.id, user.username))
@@ -276,28 +343,18 @@ class BaseHandler(web.RequestHandler):
         book_id = int(book)
         if not self.user_id():
             return
-        utils.save_user_his(self.session, action, self.current_user, book_id)
+        utils.save_user_his(self.session, action, self.principal, book_id)
 
     def del_user_history(self, action, book):
         book_id = int(book)
         if not self.user_id():
             return
-        extra = self.current_user.extra
-        history = extra.get(action, [])
-        if len(history) > 0:
-            for i in range(0, len(history)):
-                if history[i] == book_id:
-                    history.pop(i)
-                    break
-
-        extra[action] = history
-        user = self.current_user
-        user.extra.update(extra)
-        try:
-            self.session.commit()
-        except Exception as e:
-            self.session.rollback()
-            logging.warning("some err: %r" % e)
+        utils.del_user_his(self.session, action, self.user_id(), book_id)
+
+    def in_user_history(self, action, book):
+        if not self.user_id():
+            return False
+        return utils.has_user_his(self.session, action, self.user_id(), int(book))
 
     def last_modified(self, updated):
         """
@@ -383,14 +440,12 @@ class BaseHandler(web.RequestHandler):
             else:
                 request.user.avatar = request.user.avatar.replace("http://", "//")
 
-        last_week = datetime.datetime.now() - datetime.timedelta(days=7)
+        stats = self.site_stats.get()
         page_vars = {
             "db": self.db,
             "messages": self.pop_messages(),
-            "count_all_users": self.session.query(sql_func.count(Reader.id)).scalar(),
-            "count_hot_users": self.session.query(sql_func.count(Reader.id))
-            .filter(Reader.access_time > last_week)
-            .scalar(),
+            "count_all_users": stats["users"],
+            "count_hot_users": stats["active"],
             "IMG": self.cdn_url,
             "SITE_TITLE": CONF["site_title"],
         }
@@ -439,87 +494,60 @@ class BaseHandler(web.RequestHandler):
             maps[b.book_id] = d
         for book in books:
             book.update(maps.get(book["id"], empty_item))
+            # 合并尚未写入数据库的计数
+            for k, n in self.counters.pending(book["id"]).items():
+                book[k] = (book.get(k) or 0) + n
         logging.debug(
             "[%5d ms] select books from database (count = %d)" % (int(1000 * (time.time() - _ts)), len(books))
         )
         return books
 
+    # 卡片只展示书名、简介和封面；last_modified用于封面URL和格式化缓存，cover用于首页过滤没有封面的书籍
+    LIST_CARD_FIELDS = ("title", "comments", "last_modified", "cover")
+
+    def get_book_cards(self, ids):
+        """列表页的卡片只需要少量字段，直接从calibre的内存缓存中批量读取，结果按ids的顺序排列"""
+        _ts = time.time()
+        idset = self.book_ids.idset
+        ids = [i for i in ids if i in idset]
+        fields = dict((f, self.cache.all_field_for(f, ids)) for f in self.LIST_CARD_FIELDS)
+        books = []
+        for book_id in ids:
+            book = {"id": book_id}
+            for f in self.LIST_CARD_FIELDS:
+                book[f] = fields[f].get(book_id)
+            books.append(book)
+        logging.debug("[%5d ms] select book cards (count = %d)" % (int(1000 * (time.time() - _ts)), len(books)))
+        return books
+
     def check_and_increase_download_count(self):
         if self.is_admin():
             return
 
-        max_download_count = int(self.settings["downloads_count_per_ip_limitation"])
-        if max_download_count <= 0:
-            return
-
-        try:
-            ipdownloads = self.session.query(IpDownloads).filter(IpDownloads.ip == self.request.remote_ip + "").one()
-        except:
-            logging.info("first time download: " + self.request.remote_ip)
-            ipdownloads = IpDownloads()
-            ipdownloads.ip = self.request.remote_ip + ""
-            ipdownloads.starttime = datetime.datetime.now()
-            ipdownloads.dcount = 1
-            try:
-                ipdownloads.save()
-            except Exception as e:
-                self.session.rollback()
-                logging.warning("some err: %r" % e)
+        ip_limit = int(self.settings["downloads_count_per_ip_limitation"])
+        user_limit = int(self.settings.get("downloads_count_per_user_limitation", 0))
+        limits = [(self.request.remote_ip, ip_limit)]
+        user_id = self.user_id()
+        if user_id:
+            limits.append(("user:%d" % user_id, user_limit))
 
-        interval = datetime.datetime.now() - ipdownloads.starttime
-        if interval.seconds >= 24 * 3600:
-            ipdownloads.starttime = datetime.datetime.now()
-            ipdownloads.dcount = 1
+        over = self.download_limiter.acquire(limits)
+        if over is None:
+            return
+        if over[0].startswith("user:"):
+            msg = _(u"由于服务器压力过载，每个用户一天最多下载/推送%d本书") % over[1]
         else:
-            if ipdownloads.dcount >= max_download_count:
-                raise web.HTTPError(400, reason=_(
-                    u"由于服务器压力过载，每个IP地址一天最多下载/推送%d本书" % max_download_count))
-            ipdownloads.dcount += 1
-
-        try:
-            self.session.commit()
-        except Exception as e:
-            self.session.rollback()
-            logging.warning("some err: %r" % e)
+            msg = _(u"由于服务器压力过载，每个IP地址一天最多下载/推送%d本书") % over[1]
+        raise web.HTTPError(400, reason=msg)
 
     def count_increase(self, book_id, **kwargs):
         g = kwargs.get("count_guest", 0)
         v = kwargs.get("count_visit", 0)
         d = kwargs.get("count_download", 0)
 
-        try:
-            item = self.session.query(Item).filter(Item.book_id == book_id).one()
-        except:
-            item = Item()
-            item.book_id = book_id
-            item.save()
-        item.count_guest += g
-        item.count_visit += v
-        item.count_download += d
-        try:
-            self.session.commit()
-        except Exception as e:
-            self.session.rollback()
-            logging.warning("some err: %r" % e)
-
-        for o in [{"key": "visit", "value": v}, {"key": "download", "value": d}]:
-            if o["value"] > 0:
-                try:
-                    s = self.session.query(KeyValueStore).filter(KeyValueStore.key == o["key"]).one()
-                    s.value = int(s.value) + o["value"]
-                except:
-                    s = KeyValueStore()
-                    s.key = o["key"]
-                    s.value = "1"
-                    s.save()
-
-                try:
-                    self.session.commit()
-                except Exception as e:
-                    self.session.rollback()
-                    logging.warning("some err: %r" % e)
-
-        return item.website
+        # 计数先写入内存缓冲区，定期批量写入数据库
+        self.counters.add(book_id, guest=g, visit=v, download=d)
+        self.hot_ranking.increase(int(book_id), visit=v, download=d)
 
     def search_for_books(self, query):
         self.search_restriction = ""
@@ -531,31 +559,39 @@ class BaseHandler(web.RequestHandler):
         )
 
     def all_tags_with_count(self):
-        sql = """SELECT tags.name, count(distinct book) as count
-        FROM tags left join books_tags_link on tags.id = books_tags_link.tag
-        group by tags.id"""
-        tags = dict((i[0], i[1]) for i in self.cache.backend.conn.get(sql))
-        return tags
+        def load():
+            sql = """SELECT tags.name, count(distinct book) as count
+            FROM tags left join books_tags_link on tags.id = books_tags_link.tag
+            group by tags.id"""
+            return dict((i[0], i[1]) for i in self.cache.backend.conn.get(sql))
+
+        return self.category_counts.get("tags", load)
 
     def get_category_with_count(self, field):
-        table = field if field in ["series"] else field + "s"
-        name_column = "A.rating as name" if field in ["rating"] else "A.name"
-        args = {"table": table, "field": field, "name_column": name_column}
-        sql = (
-                """SELECT A.id, %(name_column)s, count(distinct book) as count
-                FROM %(table)s as A left join books_%(table)s_link as B
-                on A.id = B.%(field)s group by A.id"""
-                % args
-        )
-        logging.debug(sql)
-        rows = self.cache.backend.conn.get(sql)
-        items = [{"id": a, "name": b, "count": c} for a, b, c in rows]
-        return items
+        def load():
+            table = field if field in ["series"] else field + "s"
+            name_column = "A.rating as name" if field in ["rating"] else "A.name"
+            args = {"table": table, "field": field, "name_column": name_column}
+            sql = (
+                    """SELECT A.id, %(name_column)s, count(distinct book) as count
+                    FROM %(table)s as A left join books_%(table)s_link as B
+                    on A.id = B.%(field)s group by A.id"""
+                    % args
+            )
+            logging.debug(sql)
+            rows = self.cache.backend.conn.get(sql)
+            return [{"id": a, "name": b, "count": c} for a, b, c in rows]
+
+        # 调用方会对结果排序、追加，因此返回副本
+        return [dict(v) for v in self.category_counts.get("category:" + field, load)]
 
     def get_bookcount_without_rating(self):
-        sql = """select count(id) as cc from books where id not in (select book from books_ratings_link)"""
-        rows = self.cache.backend.conn.get(sql)
-        return rows[0][0]
+        def load():
+            sql = """select count(id) as cc from books where id not in (select book from books_ratings_link)"""
+            rows = self.cache.backend.conn.get(sql)
+            return rows[0][0]
+
+        return self.category_counts.get("without_rating", load)
 
     def get_book_names_dup(self):
         sql = """select title,count(title) as c from books group by title order by c desc"""
@@ -569,16 +605,8 @@ class BaseHandler(web.RequestHandler):
             items.append(a)
         return items, total
 
-    def get_book_ids_without_rating(self):
-        sql = """select id from books where id not in (select book from books_ratings_link) order by id desc"""
-        rows = self.cache.backend.conn.get(sql)
-        ids = [x[0] for x in rows]
-        return ids
-
     def books_by_id(self):
-        sql = "SELECT id FROM books order by id desc"
-        ids = [v[0] for v in self.cache.backend.conn.get(sql)]
-        return ids
+        return self.book_ids.ids
 
     def get_argument_start(self):
         start = self.get_argument("start", 0)
@@ -588,6 +616,20 @@ class BaseHandler(web.RequestHandler):
             start = 0
         return max(0, start)
 
+    def get_page_start(self, ids, key_at, reverse=True):
+        """分页的起始位置：有after游标时二分定位，不受前面新增、删除书籍的影响；否则按start偏移"""
+        after = self.get_argument("after", "")
+        cursor = decode_cursor(after) if after else None
+        if cursor is None:
+            return self.get_argument_start()
+        return seek(len(ids), key_at, cursor, reverse)
+
+    def get_next_cursor(self, ids, end, key_at):
+        """下一页的游标，没有更多数据时返回空字符串"""
+        if end <= 0 or end >= len(ids):
+            return ""
+        return encode_cursor(key_at(end - 1))
+
     def get_path_progress(self, book_id):
         return os.path.join(CONF["progress_path"], "progress-%s.log" % book_id)
 
@@ -650,14 +692,6 @@ class BaseHandler(web.RequestHandler):
 
 
 class ListHandler(BaseHandler):
-    def get_item_books(self, category, name):
-        books = []
-        item_id = self.cache.get_item_id(category, name)
-        if item_id:
-            ids = self.db.get_books_for_category(category, item_id)
-            books = self.db.get_data_as_dict(ids=ids)
-        return books
-
     def do_sort(self, items, field, ascending):
         items.sort(key=lambda x: x[field], reverse=not ascending)
 
@@ -677,36 +711,32 @@ class ListHandler(BaseHandler):
         return None
 
     @js
-    def render_book_list(self, ids=None, title=None, sort_by_id=False):
-        start = self.get_argument_start()
+    def render_book_list(self, ids=None, title=None, sort_by_id=False, key_at=None):
+        """key_at(i)返回ids[i]的排序键，ids需按该键倒序排列；默认按书籍ID排序"""
+        self.check_not_modified()
+        if key_at is None:
+            key_at = lambda i: (ids[i],)  # noqa: E731
+        start = self.get_page_start(ids, key_at)
         try:
             size = int(self.get_argument("size"))
         except:
             size = 60
         delta = min(max(size, 60), 100)
 
-        ids = list(ids)
+        # ids可以是list或array，只处理当前页，避免复制整个列表
         count = len(ids)
-        books = self.get_books(ids=ids[start: start + delta])
+        page_ids = list(ids[start: start + delta])
+        books = self.get_book_cards(page_ids)
         if sort_by_id:
             # 归一化，按照id从大到小排列。
             self.do_sort(books, "id", False)
-        else:
-            # 按照输入的id列表进行排序。
-            hbs = {}
-            hb_list = []
-            for b in books:
-                hbs[b["id"]] = b
-            for idx in ids:
-                if idx in hbs:
-                    hb_list.append(hbs[idx])
-            books = hb_list
 
         return {
             "err": "ok",
             "title": title,
             "total": count,
             "books": [self.fmt(b) for b in books],
+            "next": self.get_next_cursor(ids, start + delta, key_at),
         }
 
     def fmt(self, b):
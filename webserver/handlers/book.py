@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import datetime
+import email.utils
 import functools
 import logging
 import os
 import queue
-import random
 import re
 import subprocess
 import threading
@@ -17,8 +18,8 @@ import tornado.escape
 from tornado import web, iostream, httputil
 
 from webserver import constants, loader, utils
-from webserver.handlers.base import BaseHandler, ListHandler, js
-from webserver.models import Item
+from webserver.handlers.base import BaseHandler, ListHandler, NotModified, js
+from webserver.models import Item, ItemDaily
 from webserver.plugins.meta import baike, douban
 from webserver.utils import check_email, PdfCopyer, adjust_book_info
 
@@ -76,20 +77,18 @@ class Index(BaseHandler):
         cnt_random = min(int(self.get_argument("random", "0")), 30)
         cnt_recent = min(int(self.get_argument("recent", "0")), 30)
 
-        ids = list(self.cache.search(""))
-        if not ids:
+        if not len(self.book_ids):
             raise web.HTTPError(404, reason=_(u"本书库暂无藏书"))
 
         random_books = []
         new_books = []
         if cnt_random > 0:
-            random_ids = random.sample(ids, min(cnt_random, len(ids)))
-            random_books = [b for b in self.get_books(ids=random_ids) if b["cover"]]
+            random_ids = self.book_ids.sample(cnt_random)
+            random_books = [b for b in self.get_book_cards(random_ids) if b["cover"]]
             random_books.sort(key=lambda x: x["id"], reverse=True)
         if cnt_recent > 0:
-            ids.sort(reverse=True)
-            new_ids = random.sample(ids[0:100], min(cnt_recent, len(ids)))
-            new_books = [b for b in self.get_books(ids=new_ids) if b["cover"]]
+            new_ids = self.book_ids.sample(cnt_recent, population=100)
+            new_books = [b for b in self.get_book_cards(new_ids) if b["cover"]]
             new_books.sort(key=lambda x: x["id"], reverse=True)
 
         return {
@@ -103,23 +102,36 @@ class Index(BaseHandler):
 class BookDetail(BaseHandler):
     @js
     def get(self, id):
-        book = self.get_book(id)
+        book_id = int(id)
+        if book_id not in self.book_ids.idset:
+            # 书籍不存在，由get_book返回错误信息
+            self.get_book(id)
+
+        # 检查用户是否收藏了本书。
+        is_fav = self.in_user_history("fav_history", id)
+        douban_id = self.session.query(Item.website).filter(Item.book_id == book_id).scalar() or ""
+
+        # 详情不包含访问和下载计数（由BookCounts单独返回），在计数之前生成ETag；
+        # 客户端缓存仍有效时，同样记录浏览历史和访问次数
+        perms = self.principal.permission if self.principal else ""
+        last_modified = self.cache.field_for("last_modified", book_id)
+        not_modified = False
+        try:
+            self.check_not_modified(last_modified, douban_id, is_fav, perms, CONF["smtp_username"])
+        except NotModified:
+            not_modified = True
         self.user_history("visit_history", id)
-        douban_id = self.count_increase(id, count_visit=1)
+        self.count_increase(id, count_visit=1)
+        if not_modified:
+            raise NotModified()
+
+        book = self.get_book(id)
         if not douban_id:
             douban_id = self.fetch_douban_id(book, id)
-
-        # 检查用户是否收藏了本书。
-        is_fav = False
-        if self.current_user and self.current_user.extra:
-            favs = self.current_user.extra.get("fav_history", [])
-            if len(favs) > 0:
-                for i in range(0, len(favs)):
-                    if favs[i] == int(id):
-                        is_fav = True
-                        break
         book = utils.BookFormatter(self, book).format(with_files=True, with_perms=True)
         book.update({"fav": is_fav})
+        for k in ("count_visit", "count_download"):
+            book.pop(k, None)
 
         return {
             "err": "ok",
@@ -174,16 +186,34 @@ class BookDetail(BaseHandler):
         return douban_id
 
 
+class BookCounts(BaseHandler):
+    """书籍的访问和下载计数，变化频繁，不随详情一起缓存"""
+
+    @js
+    def get(self, id):
+        book_id = int(id)
+        if book_id not in self.book_ids.idset:
+            return {"err": "params.book.invalid", "msg": _(u"书籍不存在")}
+        row = self.session.query(Item.count_visit, Item.count_download).filter(Item.book_id == book_id).first()
+        counts = {"count_visit": row[0] if row else 0, "count_download": row[1] if row else 0}
+        # 合并尚未写入数据库的计数
+        for k, n in self.counters.pending(book_id).items():
+            if k in counts:
+                counts[k] += n
+        counts["err"] = "ok"
+        return counts
+
+
 class BookFavor(BaseHandler):
     @js
     def post(self, id):
-        if not self.current_user:
+        if not self.principal:
             return {
                 "err": "error",
                 "msg": _(u"请登录后操作"),
                 "to": "/login?from=/book/%d" % int(id)
             }
-        if not self.current_user.is_active():
+        if not self.principal.is_active():
             return {
                 "err": "error",
                 "msg": _(u"请先激活账号后操作"),
@@ -199,13 +229,13 @@ class BookFavor(BaseHandler):
 
     @js
     def delete(self, id):
-        if not self.current_user:
+        if not self.principal:
             return {
                 "err": "error",
                 "msg": _(u"请登录后操作"),
                 "to": "/login?from=/book/%d" % int(id)
             }
-        if not self.current_user.is_active():
+        if not self.principal.is_active():
             return {
                 "err": "error",
                 "msg": _(u"请先激活账号后操作"),
@@ -224,7 +254,7 @@ class BookFavor(BaseHandler):
 class BookRefer(BaseHandler):
     @js
     def get(self, id):
-        if not self.current_user:
+        if not self.principal:
             return self.redirect("/login?from=/book/%d" % int(id))
 
         book_id = int(id)
@@ -254,7 +284,7 @@ class BookRefer(BaseHandler):
 
     @js
     def post(self, id):
-        if not self.current_user:
+        if not self.principal:
             return self.redirect("/login?from=/book/%d" % int(id))
 
         provider_key = self.get_argument("provider_key", "error")
@@ -274,7 +304,7 @@ class BookRefer(BaseHandler):
         if not mi:
             return {"err": "params.book.invalid", "msg": _(u"书籍不存在")}
         if not (self.is_admin() or (
-                self.is_book_owner(book_id, self.user_id()) and self.current_user.can_edit(check=True))):
+                self.is_book_owner(book_id, self.user_id()) and self.principal.can_edit(check=True))):
             return {"err": "user.no_permission", "msg": _(u"无权限")}
 
         refer_mi = utils.plugin_get_book_meta(provider_key, provider_value, mi)
@@ -290,6 +320,7 @@ class BookRefer(BaseHandler):
             self.update_book_meta(mi, refer_mi)
 
         self.db.set_metadata(book_id, mi)
+        self.formatted_books.invalidate(book_id)
 
         if only_cover != "yes":
             self.set_website(book_id, provider_key, provider_value)
@@ -300,7 +331,7 @@ class BookRefer(BaseHandler):
 class BookEdit(BaseHandler):
     @js
     def post(self, id):
-        if not self.current_user:
+        if not self.principal:
             return self.redirect("/login?from=/book/%d" % int(id))
 
         book = self.get_book(id)
@@ -311,7 +342,7 @@ class BookEdit(BaseHandler):
             cid = book["collector"]["id"]
         else:
             cid = book["collector"].id
-        if not (self.is_admin() or (self.current_user.can_edit(check=True) and self.is_book_owner(bid, cid))):
+        if not (self.is_admin() or (self.principal.can_edit(check=True) and self.is_book_owner(bid, cid))):
             return {"err": "permission", "msg": _(u"无权操作")}
 
         data = tornado.escape.json_decode(self.request.body)
@@ -344,13 +375,14 @@ class BookEdit(BaseHandler):
             self.db.set_tags(bid, [])
 
         self.db.set_metadata(bid, mi)
+        self.formatted_books.invalidate(bid)
         return {"err": "ok", "msg": _(u"更新成功")}
 
 
 class BookDelete(BaseHandler):
     @js
     def post(self, id):
-        if not self.current_user:
+        if not self.principal:
             return self.redirect("/login?from=/book/%d" % int(id))
 
         book = self.get_book(id)
@@ -359,14 +391,17 @@ class BookDelete(BaseHandler):
             cid = book["collector"]["id"]
         else:
             cid = book["collector"].id
-        if not (self.is_admin() or (self.current_user.can_edit(check=True) and self.is_book_owner(bid, cid))):
+        if not (self.is_admin() or (self.principal.can_edit(check=True) and self.is_book_owner(bid, cid))):
             return {"err": "permission", "msg": _(u"没有编辑书籍的权限")}
 
-        if not (self.is_admin() or (self.current_user.can_delete(check=True) and self.is_book_owner(bid, cid))):
+        if not (self.is_admin() or (self.principal.can_delete(check=True) and self.is_book_owner(bid, cid))):
             return {"err": "permission", "msg": _(u"无权删除书籍")}
 
         self.session.query(Item).filter(Item.book_id == bid).delete()
+        self.session.query(ItemDaily).filter(ItemDaily.book_id == bid).delete()
+        self.counters.discard(bid)
         self.db.delete_book(bid)
+        self.formatted_books.invalidate(bid)
         logging.info("deleted one book: user: %d, %s" % (self.user_id(), book))
         self.session.commit()
         # self.add_msg("success", _(u"删除书籍《%s》") % book["title"])
@@ -374,19 +409,21 @@ class BookDelete(BaseHandler):
 
 
 class BookDownload(BaseHandler):
+    CHUNK_SIZE = 64 * 1024
+
     def send_error_of_not_invited(self):
         self.set_header("WWW-Authenticate", "Basic")
         self.set_status(401)
         raise web.Finish()
 
-    def get(self, id, fmt):
+    async def get(self, id, fmt):
         is_opds = self.get_argument("from", "") == "opds"
         if not CONF["ALLOW_GUEST_DOWNLOAD"]:
             if is_opds:
                 return self.send_error_of_not_invited()
-            elif not self.current_user:
+            elif not self.principal:
                 return self.redirect("/login?from=/book/%d" % int(id))
-            elif not self.current_user.can_save(check=True):
+            elif not self.principal.can_save(check=True):
                 raise web.HTTPError(403, reason=_(u"无权操作"))
 
         fmt = fmt.lower()
@@ -396,15 +433,26 @@ class BookDownload(BaseHandler):
         if "fmt_%s" % fmt not in book:
             raise web.HTTPError(404, reason=_(u"%s格式无法下载" % fmt))
 
-        # 非管理员，每天限制下载的书本数量。
-        if not (fmt == "pdf" and self.request.headers.get("Range") is not None):
+        path = book["fmt_%s" % fmt]
+        stat = os.stat(path)
+        size = stat.st_size
+        self.set_header("Accept-Ranges", "bytes")
+        # 与nginx生成的ETag格式一致，开启X-Accel-Redirect前后客户端的缓存和断点续传都可以继续使用
+        self.set_header("Etag", '"%x-%x"' % (int(stat.st_mtime), size))
+        self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(int(stat.st_mtime)))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        start, end = self.get_request_range(size, int(stat.st_mtime))
+
+        # 非管理员，每天限制下载的书本数量；断点续传的后续请求不再重复计数。
+        if start == 0 and self.request.method != "HEAD":
             self.check_and_increase_download_count()
             self.user_history("download_history", book_id)
             self.count_increase(book_id, count_download=1)
 
-        path = book["fmt_%s" % fmt]
         book["fmt"] = fmt
-        # orig_title = book["title"]
         book["title"] = urllib.parse.quote_plus(book["title"])
         fname = "%(title)s.%(fmt)s" % book
         att = u"attachment; filename=\"%s\"; filename*=UTF-8''%s" % (fname, fname)
@@ -412,86 +460,129 @@ class BookDownload(BaseHandler):
             att = u'attachment; filename="%(id)d.%(fmt)s"' % book
 
         self.set_header("Content-Disposition", att.encode("UTF-8"))
-
         if fmt == "pdf":
             self.set_header("Content-Type", "application/pdf")
-            # try:
-            #     with open(path, "rb") as f:
-            #         pc = PdfCopyer()
-            #         pc(f, orig_title).write(BookStream(self))
-            # except Exception as e:
-            #     logging.warning("some pdf error: %r" % e)
-            self.range_get_pdf(path)
         else:
             self.set_header("Content-Type", "application/octet-stream")
-            with open(path, "rb") as f:
-                self.write(f.read())
+        if self.accel_redirect(path):
+            return
 
-    def range_get_pdf(self, path):
-        self.set_header("Accept-Ranges", "bytes")
-        request_range = None
+        # Note: only return HTTP 206 if less than the entire range has been
+        # requested. Not only is this semantically correct, but Chrome
+        # refuses to play audio if it gets an HTTP 206 in response to
+        # ``Range: bytes=0-``.
+        if end - start != size:
+            self.set_status(206)  # Partial Content
+            self.set_header("Content-Range", httputil._get_content_range(start, end, size))
+        self.set_header("Content-Length", end - start)
+        if self.request.method == "HEAD":
+            return
+        await self.send_file(path, start, end)
+
+    def accel_redirect(self, path):
+        """由nginx发送文件（sendfile、Range和keep-alive都由nginx处理），tornado只负责鉴权和计数"""
+        prefix = CONF.get("download_accel_redirect", "")
+        if not prefix:
+            return False
+        relpath = os.path.relpath(path, self.db.library_path)
+        if relpath.startswith(".."):
+            logging.warning("file is not in library, can not use X-Accel-Redirect: %s" % path)
+            return False
+        self.set_header("X-Accel-Redirect", prefix.rstrip("/") + "/" + urllib.parse.quote(relpath))
+        return True
+
+    def get_request_range(self, size, mtime):
+        """解析Range头，返回需要发送的[start, end)"""
         range_header = self.request.headers.get("Range")
-        if range_header:
-            # As per RFC 2616 14.16, if an invalid Range header is specified,
-            # the request will be treated as if the header didn't exist.
-            request_range = httputil._parse_request_range(range_header)
-
-        file_stat = os.stat(path)
-        size = file_stat.st_size
-
-        if request_range:
-            start, end = request_range
-            if start is not None and start < 0:
-                start += size
-                if start < 0:
-                    start = 0
-            if (start is not None
-                and (start >= size or (end is not None and start >= end))) \
-                    or end == 0:
-                # As per RFC 2616 14.35.1, a range is not satisfiable only: if
-                # the first requested byte is equal to or greater than the
-                # content, or when a suffix with length 0 is specified.
-                # https://tools.ietf.org/html/rfc7233#section-2.1
-                # A byte-range-spec is invalid if the last-byte-pos value is present
-                # and less than the first-byte-pos.
-                self.set_status(416)  # Range Not Satisfiable
-                self.set_header("Content-Type", "text/plain")
-                self.set_header("Content-Range", "bytes */%s" % (size,))
-                return
-            if end is not None and end > size:
-                # Clients sometimes blindly use a large range to limit their
-                # download size; cap the endpoint at the actual file size.
-                end = size
-            # Note: only return HTTP 206 if less than the entire range has been
-            # requested. Not only is this semantically correct, but Chrome
-            # refuses to play audio if it gets an HTTP 206 in response to
-            # ``Range: bytes=0-``.
-            if size != (end or size) - (start or 0):
-                self.set_status(206)  # Partial Content
-                self.set_header("Content-Range", httputil._get_content_range(start, end, size))
-        else:
-            start = end = None
-
-        if start is not None and end is not None:
-            content_length = end - start
-        elif end is not None:
-            content_length = end
-        elif start is not None:
-            content_length = size - start
+        # As per RFC 2616 14.16, if an invalid Range header is specified,
+        # the request will be treated as if the header didn't exist.
+        request_range = httputil._parse_request_range(range_header) if range_header else None
+        if not request_range or not self.if_range_matched(mtime):
+            return 0, size
+
+        start, end = request_range
+        if start is not None and start < 0:
+            start = max(0, start + size)
+        if (start is not None and (start >= size or (end is not None and start >= end))) or end == 0:
+            # As per RFC 2616 14.35.1, a range is not satisfiable only: if
+            # the first requested byte is equal to or greater than the
+            # content, or when a suffix with length 0 is specified.
+            self.set_status(416)  # Range Not Satisfiable
+            self.set_header("Content-Type", "text/plain")
+            self.set_header("Content-Range", "bytes */%s" % (size,))
+            raise web.Finish()
+        # Clients sometimes blindly use a large range to limit their
+        # download size; cap the endpoint at the actual file size.
+        return start or 0, min(end, size) if end is not None else size
+
+    def if_range_matched(self, mtime):
+        """If-Range可以是ETag或者修改时间；文件已经变化时，忽略Range，返回完整的文件"""
+        if_range = self.request.headers.get("If-Range")
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == self._headers.get("Etag")
+        date_tuple = email.utils.parsedate_tz(if_range)
+        if not date_tuple:
+            return False
+        return email.utils.mktime_tz(date_tuple) == mtime
+
+    async def send_file(self, path, start, end):
+        """分块发送文件，每块写入socket之后再读取下一块，每个连接最多占用一块的内存"""
+        remaining = end - start
+        with open(path, "rb") as f:
+            f.seek(start)
+            while remaining > 0:
+                chunk = f.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                try:
+                    await self.flush()
+                except iostream.StreamClosedError:
+                    logging.info("download of %s is interrupted" % path)
+                    return
+
+
+class BookBatch(ListHandler):
+    """批量获取书籍信息：/api/books?ids=1,2,3&fields=title,tags
+
+    未指定fields或只需要卡片字段时，返回列表卡片；否则返回详情中对应的字段"""
+
+    MAX_IDS = 300
+    CARD_FIELDS = frozenset(["id", "title", "comments", "img"])
+
+    @js
+    def get(self):
+        try:
+            ids = [int(v) for v in self.get_argument("ids", "").split(",") if v.strip()]
+        except ValueError:
+            return {"err": "params.invalid", "msg": _(u"书籍ID格式错误")}
+        if not ids or len(ids) > self.MAX_IDS:
+            return {"err": "params.invalid", "msg": _(u"每次可查询1～%d本书籍") % self.MAX_IDS}
+        ids = list(dict.fromkeys(ids))
+        fields = set(v.strip() for v in self.get_argument("fields", "").split(",") if v.strip())
+
+        self.check_not_modified()
+        if fields <= self.CARD_FIELDS:
+            books = [self.fmt(b) for b in self.get_book_cards(ids)]
         else:
-            content_length = size
-        self.set_header("Content-Length", content_length)
+            # 一次读取calibre数据，一次查询items表
+            rows = dict((b["id"], b) for b in self.get_books(ids=ids))
+            with_files = "files" in fields
+            books = [utils.BookFormatter(self, rows[i]).format(with_files=with_files) for i in ids if i in rows]
 
-        content = web.StaticFileHandler.get_content(path, start, end)
-        if isinstance(content, bytes):
-            content = [content]
-        for chunk in content:
-            self.write(chunk)
+        if fields:
+            fields.add("id")
+            books = [dict((k, v) for k, v in b.items() if k in fields) for b in books]
+        return {"err": "ok", "books": books}
 
 
 class BookNav(ListHandler):
     @js
     def get(self):
+        self.check_not_modified()
         tagmap = self.all_tags_with_count()
         navs = []
         for h1, tags in constants.BOOK_NAV:
@@ -514,46 +605,45 @@ class SearchBook(ListHandler):
             return self.write({"err": "params.invalid", "msg": _(u"请输入搜索关键字")})
 
         title = _(u"搜索：%(name)s") % {"name": name}
-        id_set = set()
-        id_list = []
-        for i in ["title", "author", "tag", "series"]:
-            ids_tmp = self.cache.search("%s:%s" % (i, name))
-            for id in ids_tmp:
-                if id not in id_set:
-                    id_set.add(id)
-                    id_list.append(id)
-            logging.info("keyword: %s:%s" % (i, name))
-            logging.info("books: {}".format(ids_tmp))
-        return self.render_book_list(ids=id_list, title=title)
+        mode = self.get_argument("mode", "")
+        scores = self.search_index.search_scores(name, mode=mode)
+        ids = sorted(scores, key=lambda k: (scores[k], k), reverse=True)
+        logging.info("keyword: %s, mode: %s, books: %d" % (name, mode, len(ids)))
+        return self.render_book_list(ids=ids, title=title, key_at=lambda i: (scores[ids[i]], ids[i]))
 
 
-class HotBook(ListHandler):
+class BookSuggest(BaseHandler):
     @js
     def get(self):
-        db_items = self.session.query(Item).filter(Item.count_visit > 1).order_by(
-            (Item.count_download + Item.count_visit * 2).desc())
-        start = self.get_argument_start()
-        delta = 60
-        items = db_items.limit(delta).offset(start).all()
-        ids = [item.book_id for item in items]
-        books = self.get_books(ids=ids)
-        from functools import cmp_to_key
-        books.sort(key=cmp_to_key(utils.compare_books_by_visit_download), reverse=True)
-        if len(books) != len(items):
-            logging.info("{}".format([b["id"] for b in books]))
-            logging.info("{}".format([b.book_id for b in items]))
+        q = self.get_argument("q", "")
+        try:
+            limit = min(max(int(self.get_argument("limit", "10")), 1), 30)
+        except:
+            limit = 10
+        return {"err": "ok", "items": self.suggest_index.suggest(q, limit=limit)}
+
 
+class HotBook(ListHandler):
+    @js
+    def get(self):
+        window = self.get_argument("window", "all")
+        if window not in self.hot_ranking.WINDOWS:
+            window = "all"
+        self.check_not_modified(self.hot_ranking.version)
         # 热度榜单最多显示120本书籍，最多两页。
-        if len(items) < delta:
-            total = start + len(items)
-        else:
-            total = 120
+        ranking = self.hot_ranking.ranked(window)
+        key_at = lambda i: ranking[i]  # noqa: E731
+        start = self.get_page_start(ranking, key_at)
+        delta = 60
+        page_ids = [book_id for score, book_id in ranking[start : start + delta]]
+        books = self.get_book_cards(page_ids)
 
         return {
             "err": "ok",
             "title": _(u"热度榜单"),
-            "total": total,
+            "total": len(ranking),
             "books": [self.fmt(b) for b in books],
+            "next": self.get_next_cursor(ranking, start + delta, key_at),
         }
 
 
@@ -572,10 +662,10 @@ class BookUpload(BaseHandler):
 
     @js
     def post(self):
-        if not self.current_user:
+        if not self.principal:
             return {"err": "need_login", "msg": _(u"请先登录"), "to": "/login"}
 
-        if not self.current_user.can_upload(check=True):
+        if not self.principal.can_upload(check=True):
             return {"err": "permission", "msg": _(u"无权上传书籍")}
 
         from calibre.ebooks.metadata.meta import get_metadata
@@ -619,6 +709,7 @@ class BookUpload(BaseHandler):
         book_id = self.db.import_book(mi, fpaths)
         # 导入成功则删除源文件
         os.remove(fpath)
+        self.suggest_index.update([book_id])
 
         self.user_history("upload_history", book_id)
         # self.add_msg("success", _(u"导入书籍成功！"))
@@ -657,9 +748,9 @@ class BookRead(BaseHandler):
                 u"不支持微信打开阅读页面，请在浏览器打开：<br/>1. 请点击右上角按钮<br/>2. 选择【在浏览器中打开】"))
 
         if not CONF["ALLOW_GUEST_READ"]:
-            if not self.current_user:
+            if not self.principal:
                 return self.redirect("/login?from=/book/%d" % int(id))
-            elif not self.current_user.can_read(check=True):
+            elif not self.principal.can_read(check=True):
                 return {"err": "permission", "msg": _(u"无权在线阅读")}
 
         book = self.get_book(id)
@@ -683,9 +774,9 @@ class BookRead(BaseHandler):
         if "fmt_pdf" in book:
             # PDF类书籍需要检查下载权限。
             if not CONF["ALLOW_GUEST_DOWNLOAD"]:
-                if not self.current_user:
+                if not self.principal:
                     return self.redirect("/login?from=/book/%d" % int(id))
-                elif not self.current_user.can_save(check=True):
+                elif not self.principal.can_save(check=True):
                     raise web.HTTPError(403, reason=_(u"无权在线阅读PDF类书籍(无权下载书籍)"))
 
             # 非管理员，每天限制下载的书本数量。在线阅读PDF，相当于下载PDF。
@@ -738,6 +829,8 @@ class BookRead(BaseHandler):
 
             with open(new_path, "rb") as f:
                 self.db.add_format(book["id"], new_fmt, f, index_is_id=True)
+                self.formatted_books.invalidate(book["id"])
+                self.format_sizes.update([book["id"]])
                 logging.info("add new book: %s", new_path)
             fpath = new_path
 
@@ -761,10 +854,10 @@ class BookPush(BaseHandler):
             return {"err": "params.error", "msg": _(u"Email无效")}
 
         if not CONF["ALLOW_GUEST_PUSH"]:
-            if not self.current_user:
+            if not self.principal:
                 return {"err": "permission", "msg": _(u"不支持未登录用户推送书籍，请先登录账号。"),
                         "to": "/login?from=/book/%s" % str(id)}
-            elif not self.current_user.can_push(check=True):
+            elif not self.principal.can_push(check=True):
                 return {"err": "permission", "msg": _(u"无权推送书籍")}
 
         # 非管理员，每天限制下载的书本数量。
@@ -780,7 +873,7 @@ class BookPush(BaseHandler):
         for fmt in ["mobi", "azw", "epub", "pdf"]:
             fpath = book.get("fmt_%s" % fmt, None)
             if fpath:
-                filesize = int(self.db.sizeof_format(book_id, fmt, index_is_id=True))
+                filesize = int(self.format_sizes.size(book_id, fmt) or 0)
                 if filesize > 4 * 1024 * 1024:
                     return {
                         "err": "book.file_too_large",
@@ -836,6 +929,8 @@ class BookPush(BaseHandler):
             return None
         with open(new_path, "rb") as f:
             self.db.add_format(book["id"], new_fmt, f, index_is_id=True)
+        self.formatted_books.invalidate(book["id"])
+        self.format_sizes.update([book["id"]])
         return new_path
 
     def do_send_mail(self, book, mail_to, fmt, fpath):
@@ -881,9 +976,11 @@ def routes():
     return [
         (r"/api/index", Index),
         (r"/api/search", SearchBook),
+        (r"/api/suggest", BookSuggest),
         (r"/api/recent", RecentBook),
         (r"/api/hot", HotBook),
         (r"/api/book/nav", BookNav),
+        (r"/api/books", BookBatch),
         (r"/api/book/upload", BookUpload),
         (r"/api/book/([0-9]+)", BookDetail),
         (r"/api/book/([0-9]+)/delete", BookDelete),
@@ -891,6 +988,7 @@ def routes():
         (r"/api/book/([0-9]+)\.(.+)", BookDownload),
         (r"/api/book/([0-9]+)/push", BookPush),
         (r"/api/book/([0-9]+)/fav", BookFavor),
+        (r"/api/book/([0-9]+)/counts", BookCounts),
         (r"/api/book/([0-9]+)/refer", BookRefer),
         (r"/read/([0-9]+)", BookRead),
     ]
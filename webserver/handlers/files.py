@@ -2,13 +2,16 @@
 # -*- coding: UTF-8 -*-
 
 
+import hashlib
 import logging
 import os
 import re
 
+import tornado.ioloop
 from tornado import web
 from webserver import constants, loader
-from webserver.handlers.base import BaseHandler
+from webserver.handlers.base import BaseHandler, NotModified
+from webserver.thumbnails import IMAGE_TYPES, negotiate_format
 
 CONF = loader.get_settings()
 
@@ -19,10 +22,13 @@ class ImageHandler(BaseHandler):
         self.set_status(401)
         raise web.Finish()
 
-    def get(self, fmt, id, **kwargs):
-        self.write(self.get_data(fmt, id, **kwargs))
+    async def get(self, fmt, id, **kwargs):
+        try:
+            self.write(await self.get_data(fmt, id, **kwargs))
+        except NotModified:
+            self.set_status(304)
 
-    def get_data(self, fmt, id, **kwargs):
+    async def get_data(self, fmt, id, **kwargs):
         "Serves files, covers, thumbnails, metadata from the calibre database"
         try:
             id = int(id)
@@ -34,40 +40,51 @@ class ImageHandler(BaseHandler):
             id = int(match.group())
         if not self.db.has_id(id):
             raise web.HTTPError(404, "id:%d does not exist in database" % id)
+        self.image_format = "jpg"
+        if fmt == "cover" or fmt.startswith("thumb"):
+            # 客户端支持时返回WebP/AVIF格式，同一个URL的内容随Accept变化
+            accept = self.request.headers.get("Accept", "")
+            self.image_format = negotiate_format(accept, CONF.get("cover_image_formats", []))
+            self.set_header("Vary", "Accept")
+        if fmt in ("cover", "opf") or fmt.startswith("thumb"):
+            self.check_not_modified_since(fmt, id)
         if fmt == "thumb" or fmt.startswith("thumb_"):
             try:
                 width, height = map(int, fmt.split("_")[1:])
             except:
                 width, height = 60, 80
-            return self.get_cover(
+            return await self.get_cover(
                 id, thumbnail=True, thumb_width=width, thumb_height=height
             )
         if fmt == "cover":
-            return self.get_cover(id)
+            return await self.get_cover(id)
         if fmt == "opf":
             return self.get_metadata_as_opf(id)
         raise web.HTTPError(404, "bad url")
 
-    # Actually get content from the database {{{
-    def get_cover(self, id, thumbnail=False, thumb_width=60, thumb_height=80):
-        from calibre.utils.magick.draw import thumbnail as generate_thumbnail
+    def check_not_modified_since(self, fmt, book_id):
+        """在读取封面和元数据之前检查客户端的缓存，未变化时直接返回304
+
+        URL中的?t=<书籍修改时间>与当前版本一致时，内容变化后URL也会变化，可以让客户端长期缓存"""
+        updated = self.cache.field_for("last_modified", book_id)
+        if fmt == "opf":
+            version, mtime = book_id, updated.timestamp()
+        else:
+            version, mtime = self.thumbnails.cover_time(book_id)
+        self.cover_id = version
+        if self.get_argument("t", "") == updated.strftime("%s"):
+            self.set_header("Cache-Control", "public, max-age=31536000, immutable")
+        etag = hashlib.md5(("%s-%s-%d-%d" % (fmt, self.image_format, version, mtime)).encode("UTF-8")).hexdigest()
+        self.check_not_modified(etag=etag, mtime=mtime)
 
+    # Actually get content from the database {{{
+    async def get_cover(self, id, thumbnail=False, thumb_width=60, thumb_height=80):
         try:
-            self.set_header("Content-Type", "image/jpeg")
-            cover = self.db.cover(id, index_is_id=True)
-            if cover is None:
-                cover = self.default_cover
-                updated = self.build_time
-            else:
-                updated = self.db.cover_last_modified(id, index_is_id=True)
-            self.set_header("Last-Modified", self.last_modified(updated))
-
-            if thumbnail:
-                return generate_thumbnail(
-                    cover, width=thumb_width, height=thumb_height
-                )[-1]
-            else:
-                return cover
+            self.set_header("Content-Type", IMAGE_TYPES[self.image_format])
+            # 缩放和AVIF/WebP编码比较耗时，与ThumbnailSprite一样放到线程池中执行，避免阻塞其他请求
+            return await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, self.load_cover, id, thumbnail, thumb_width, thumb_height
+            )
         except Exception as err:
             import traceback
 
@@ -75,14 +92,58 @@ class ImageHandler(BaseHandler):
             logging.error(traceback.print_exc())
             raise web.HTTPError(404, "Failed to generate cover: %r" % err)
 
+    def load_cover(self, id, thumbnail, thumb_width, thumb_height):
+        if thumbnail:
+            return self.thumbnails.get(id, thumb_width, thumb_height, self.image_format)
+        if self.image_format != "jpg":
+            # 转换格式后的原尺寸封面也保存在缩略图缓存中
+            return self.thumbnails.get(id, 0, 0, self.image_format)
+        cover = self.db.cover(id, index_is_id=True) if self.cover_id else None
+        return cover or self.default_cover
+
     def get_metadata_as_opf(self, id_):
         from calibre.ebooks.metadata.opf2 import metadata_to_opf
 
         self.set_header("Content-Type", "application/oebps-package+xml; charset=UTF-8")
         mi = self.db.get_metadata(id_, index_is_id=True)
-        data = metadata_to_opf(mi)
-        self.set_header("Last-Modified", self.last_modified(mi.last_modified))
-        return data
+        return metadata_to_opf(mi)
+
+
+class ThumbnailSprite(BaseHandler):
+    """多本书缩略图的拼图：/get/sprite_60x80/1,2,3.jpg
+
+    列表页用一次请求代替逐本请求封面；第i本书位于第i % 列数列、第i // 列数行，
+    列数为min(10, 书籍数量)，每格大小为宽x高，缩略图居中放置"""
+
+    MAX_IDS = 100
+    MAX_SIZE = 400
+
+    async def get(self, width, height, ids):
+        width, height = int(width), int(height)
+        ids = [int(v) for v in ids.split(",") if v]
+        if not ids or len(ids) > self.MAX_IDS:
+            raise web.HTTPError(400, reason="too many books")
+        if not (0 < width <= self.MAX_SIZE and 0 < height <= self.MAX_SIZE):
+            raise web.HTTPError(400, reason="bad thumbnail size")
+        # 不存在的书籍使用默认封面占位，保持其他书籍的位置不变
+        idset = self.book_ids.idset
+        ids = [i if i in idset else 0 for i in ids]
+
+        accept = self.request.headers.get("Accept", "")
+        fmt = negotiate_format(accept, CONF.get("cover_image_formats", []))
+        self.set_header("Vary", "Accept")
+
+        # 读取封面时间、缩放和拼接封面都比较耗时，放到线程池中执行，避免阻塞其他请求
+        ioloop = tornado.ioloop.IOLoop.current()
+        name = await ioloop.run_in_executor(None, self.thumbnails.sprite_name, ids, width, height, fmt)
+        try:
+            self.check_not_modified(etag=name.split(".")[0])
+        except NotModified:
+            self.set_status(304)
+            return
+        data = await ioloop.run_in_executor(None, self.thumbnails.get_sprite, name, ids, width, height, fmt)
+        self.set_header("Content-Type", IMAGE_TYPES[fmt])
+        self.write(data)
 
 
 class ProxyImageHandler(BaseHandler):
@@ -132,6 +193,7 @@ class ProgressHandler(BaseHandler):
 def routes():
     static_config = {"path": CONF["html_path"], "default_filename": "index.html"}
     return [
+        (r"/get/sprite_([0-9]+)x([0-9]+)/([0-9,]+)\.\w+", ThumbnailSprite),
         (r"/get/pcover", ProxyImageHandler),
         (r"/get/progress/([0-9]+)", ProgressHandler),
         (r"/get/extract/(.*)", web.StaticFileHandler, {"path": CONF["extract_path"]}),
@@ -2,10 +2,8 @@
 # -*- coding: UTF-8 -*-
 import math
 import sys
-from functools import cmp_to_key
 from gettext import gettext as _
 
-from webserver import utils
 from webserver.handlers.base import ListHandler, js
 
 
@@ -37,6 +35,7 @@ class PubBooksUpdate(ListHandler):
 class MetaList(ListHandler):
     @js
     def get(self, meta):
+        self.check_not_modified()
         SHOW_NUMBER = 300
         if self.get_argument("show", "") == "all":
             SHOW_NUMBER = sys.maxsize
@@ -65,6 +64,7 @@ class MetaList(ListHandler):
 class MetaBooks(ListHandler):
     @js
     def get(self, meta, name):
+        self.check_not_modified()
         titles = {
             "tag": _(u'含有"%(name)s"标签的书籍'),
             "author": _(u'"%(name)s"编著的书籍'),
@@ -72,7 +72,6 @@ class MetaBooks(ListHandler):
             "rating": _("评分为%(name)s星的书籍"),
             "publisher": _(u'"%(name)s"出版的书籍'),
         }
-        start = self.get_argument_start()
         try:
             size = int(self.get_argument("size"))
         except:
@@ -87,21 +86,18 @@ class MetaBooks(ListHandler):
             except:
                 name = 0
 
-        if meta == "rating" and name == 0:
-            ids = self.get_book_ids_without_rating()
-            count = len(ids)
-            books = self.get_books(ids=ids[start:start + delta])
-        else:
-            books = self.get_item_books(category, name)
-            count = len(books)
-        books.sort(key=cmp_to_key(utils.compare_books_by_rating_or_id), reverse=True)
-        if not (meta == "rating" and name == 0):
-            books = books[start:start + delta]
+        ids, ratings = self.category_books.get_ranked(category, name)
+        key_at = lambda i: (ratings[i], ids[i])  # noqa: E731
+        start = self.get_page_start(ids, key_at)
+        page_ids = list(ids[start : start + delta])
+        books = self.get_book_cards(page_ids)
+        count = len(ids)
         return {
             "err": "ok",
             "title": title,
             "total": count,
             "books": [self.fmt(b) for b in books],
+            "next": self.get_next_cursor(ids, start + delta, key_at),
         }
 
 
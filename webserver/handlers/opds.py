@@ -433,6 +433,9 @@ class OpdsHandler(BaseHandler):
         self.set_status(401)
         raise web.Finish()
 
+    def get_categories(self):
+        return self.category_counts.get("opds", self.db.get_categories)
+
     def get_opds_acquisition_feed(
         self,
         ids,
@@ -494,7 +497,7 @@ class OpdsHandler(BaseHandler):
         ascending = which == "title"
         feed_title = {"newest": _("Newest"), "title": _("Title")}.get(which, which)
         feed_title = default_feed_title + " :: " + _("By {0}").format(feed_title)
-        ids = list(self.cache.search(""))
+        ids = self.book_ids.idset
         return self.get_opds_acquisition_feed(
             ids,
             offset,
@@ -515,7 +518,7 @@ class OpdsHandler(BaseHandler):
         if not which or not category:
             raise web.HTTPError(404, reason="Not found")
 
-        categories = self.db.get_categories()
+        categories = self.get_categories()
         page_url = url_for("opdscategorygroup", category=category, which=which)
 
         category = unhexlify(category)
@@ -581,7 +584,7 @@ class OpdsHandler(BaseHandler):
         raise web.HTTPError(404, reason="Not found")
 
     def get_opds_navcatalog(self, which, page_url, up_url, offset=0):
-        categories = self.db.get_categories()
+        categories = self.get_categories()
         if which not in categories:
             raise web.HTTPError(404, reason="Category %r not found" % which)
 
@@ -665,7 +668,7 @@ class OpdsHandler(BaseHandler):
                 ):
                     raise web.HTTPError(404, reason="Tag %r not found" % which)
 
-        categories = self.db.get_categories()
+        categories = self.get_categories()
         if category not in categories:
             raise web.HTTPError(404, reason="Category %r not found" % which)
 
@@ -695,7 +698,7 @@ class OpdsHandler(BaseHandler):
         )
 
     def opds(self):
-        categories = self.db.get_categories()
+        categories = self.get_categories()
         category_meta = self.db.field_metadata
         cats = [
             (_("Newest"), _("Date"), "Onewest"),
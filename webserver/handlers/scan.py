@@ -235,6 +235,7 @@ class Scanner:
                 row.book_id = self.db.import_book(mi, [fpath])
                 row.status = ScanFile.IMPORTED
                 self.save_or_rollback(row)
+                self.settings["suggest_index"].update([row.book_id])
                 user = self.session.query(Reader).filter(Reader.id == self.user_id).first()
                 if user:
                     utils.save_user_his(self.session, "upload_history", user, row.book_id)
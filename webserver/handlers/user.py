@@ -11,9 +11,9 @@ from gettext import gettext as _
 import tornado.escape
 from tornado import web
 
-from webserver import loader
+from webserver import loader, utils
 from webserver.handlers.base import BaseHandler, auth, js
-from webserver.models import Message, Reader, KeyValueStore
+from webserver.models import Message, Reader
 from webserver.utils import check_email
 from webserver.version import VERSION
 
@@ -48,6 +48,7 @@ class Done(BaseHandler):
             user = None
         else:
             user.check_and_update(si)
+            self.principals.invalidate(user.id)
         return user
 
     def get(self):
@@ -101,6 +102,8 @@ class UserUpdate(BaseHandler):
 
         try:
             self.session.commit()
+            self.principals.invalidate(user.id)
+            self.credentials.invalidate(user.id)
             self.add_msg("success", _("Settings saved."))
             return {"err": "ok"}
         except:
@@ -116,6 +119,7 @@ class SignUp(BaseHandler):
         user.active = True
         try:
             user.save()
+            self.principals.invalidate(user.id)
         except Exception as e:
             self.session.rollback()
             logging.warning("some err: %r" % e)
@@ -271,6 +275,7 @@ class UserReset(BaseHandler):
         # do save into db
         try:
             user.save()
+            self.credentials.invalidate(user.id)
             self.add_msg("success", _("你刚刚重置了密码"))
             return {"err": "ok"}
         except:
@@ -333,43 +338,23 @@ class UserMessages(BaseHandler):
 
 class UserInfo(BaseHandler):
     def get_sys_info(self):
-        from sqlalchemy import func
-
-        db = self.db
-        last_week = datetime.datetime.now() - datetime.timedelta(days=7)
-        count_all_users = self.session.query(func.count(Reader.id)).scalar()
-        count_hot_users = self.session.query(func.count(Reader.id)).filter(Reader.access_time > last_week).scalar()
-        v = "0"
-        visits = self.session.query(KeyValueStore.value).filter(KeyValueStore.key == "visit")
-        if visits.count() > 0:
-            v = visits[0].value
-        d = "0"
-        downloads = self.session.query(KeyValueStore.value).filter(KeyValueStore.key == "download")
-        if downloads.count() > 0:
-            d = downloads[0].value
-        return {
-            "books": db.count(),
-            "readcount": int(v),
-            "downloadcount": int(d),
-            "tags": len(db.all_tags()),
-            "authors": len(db.all_authors()),
-            "publishers": len(db.all_publishers()),
-            "series": len(db.all_series()),
-            "mtime": db.last_modified().strftime("%Y-%m-%d"),
-            "users": count_all_users,
-            "active": count_hot_users,
-            "version": VERSION,
-            "title": CONF["site_title"],
-            "socials": CONF["SOCIALS"],
-            "friends": CONF["FRIENDS"],
-            "footer": CONF["FOOTER"],
-            "allow": {
-                "register": CONF["ALLOW_REGISTER"],
-                "download": CONF["ALLOW_GUEST_DOWNLOAD"],
-                "push": CONF["ALLOW_GUEST_PUSH"],
-                "read": CONF["ALLOW_GUEST_READ"],
-            },
-        }
+        d = self.site_stats.get()
+        d.update(
+            {
+                "version": VERSION,
+                "title": CONF["site_title"],
+                "socials": CONF["SOCIALS"],
+                "friends": CONF["FRIENDS"],
+                "footer": CONF["FOOTER"],
+                "allow": {
+                    "register": CONF["ALLOW_REGISTER"],
+                    "download": CONF["ALLOW_GUEST_DOWNLOAD"],
+                    "push": CONF["ALLOW_GUEST_PUSH"],
+                    "read": CONF["ALLOW_GUEST_READ"],
+                },
+            }
+        )
+        return d
 
     def get_user_info(self, detail):
         user = self.current_user
@@ -405,26 +390,11 @@ class UserInfo(BaseHandler):
             d["avatar"] = user.avatar.replace("http://", "https://").replace(gravatar_url, CONF["avatar_service"])
         if user.extra:
             d["kindle_email"] = user.extra.get("kindle_email", "")
-            if detail:
-                for k, v in user.extra.items():
-                    if not k.endswith("_history") or not v:
-                        continue
-
-                    hbs = {}
-                    hb_list = []
-                    # 只取前60本。
-                    books = self.db.get_data_as_dict(ids=v[:100])
-                    for b in books:
-                        hb = {
-                            "id": b["id"],
-                            "lm": b["last_modified"].strftime("%s"),
-                            "title": b["title"]
-                        }
-                        hbs[hb["id"]] = hb
-                    for idx in v:
-                        if idx in hbs:
-                            hb_list.append(hbs[idx])
-                    d["extra"][k] = hb_list[:60]
+        if detail:
+            for k, ids in utils.get_user_his(self.session, user.id, limit=100).items():
+                # 只取前60本。
+                books = self.get_book_cards(ids)[:60]
+                d["extra"][k] = [{"id": b["id"], "lm": b["last_modified"].strftime("%s"), "title": b["title"]} for b in books]
         return d
 
     @js
@@ -454,19 +424,19 @@ class UserInfo(BaseHandler):
 class ClearUserHis(BaseHandler):
     @js
     def delete(self):
-        if not self.current_user:
+        if not self.principal:
             return {
                 "err": "error",
                 "msg": _(u"请登录后操作"),
                 "to": "/login?from=/user/history"
             }
-        if not self.current_user.is_active():
+        if not self.principal.is_active():
             return {
                 "err": "error",
                 "msg": _(u"请先激活账号后操作"),
             }
 
-        user = self.current_user
+        user = self.principal
         action = self.get_argument("action", None)
         if action:
             action += "_history"
@@ -476,13 +446,7 @@ class ClearUserHis(BaseHandler):
                 "msg": _(u"清理目标为空")
             }
 
-        if user.extra and action and action in user.extra:
-            del user.extra[action]
-            try:
-                user.save()
-            except Exception as e:
-                self.session.rollback()
-                logging.warning("some err: %r" % e)
+        utils.del_user_his(self.session, action, user.id)
 
         return {
             "err": "ok",
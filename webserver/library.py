@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import base64
+import json
+import logging
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+def encode_cursor(key):
+    """把排序键编码为不透明的分页游标"""
+    s = json.dumps(list(key), separators=(",", ":"))
+    return base64.urlsafe_b64encode(s.encode("UTF-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("UTF-8")
+        key = json.loads(s)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(key, list) or not key or not all(isinstance(v, int) for v in key):
+        return None
+    return tuple(key)
+
+
+def seek(count, key_at, cursor, reverse=True):
+    """在按key_at(i)排序（reverse为True时倒序）的序列中二分查找，返回游标之后第一个元素的位置"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        key = key_at(mid)
+        if (key >= cursor) if reverse else (key <= cursor):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class LibraryWatcher:
+    """监听calibre书库的变更，维护全局版本号，并通知各个内存索引进行更新"""
+
+    def __init__(self):
+        self.boot = int(time.time())
+        self.version = 0
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # calibre内部使用弱引用保存listener，因此这里必须保持一个强引用
+        self._calibre_listener = None
+
+    def subscribe(self, callback):
+        """callback(book_ids)，book_ids为None时表示需要全量刷新"""
+        self.subscribers.append(callback)
+
+    def changed(self, book_ids=None):
+        if book_ids is not None:
+            book_ids = set(int(i) for i in book_ids)
+        with self.lock:
+            self.version += 1
+        for callback in self.subscribers:
+            try:
+                callback(book_ids)
+            except:
+                import traceback
+
+                logging.error("Failed to notify library change:")
+                logging.error(traceback.format_exc())
+
+    def attach(self, cache):
+        """绑定calibre的事件通知（calibre在独立线程中回调）"""
+        add_listener = getattr(cache, "add_listener", None)
+        if add_listener is None:
+            logging.warning("calibre does not support db listeners, memory indexes will not be refreshed")
+            return
+
+        def on_event(event_type, library_id, event_data):
+            self.changed(self.parse_event(event_type, event_data))
+
+        self._calibre_listener = on_event
+        add_listener(on_event)
+
+    def parse_event(self, event_type, event_data):
+        name = getattr(event_type, "name", str(event_type))
+        try:
+            if name == "metadata_changed":
+                return event_data[1]
+            if name in ("book_created", "book_edited"):
+                return [event_data[0]]
+            if name == "books_removed":
+                return event_data[0]
+            if name == "format_added":
+                # event_data: (book_id, fmt)
+                return [event_data[0]]
+            if name == "formats_removed":
+                # event_data: ({book_id: formats},)
+                return list(event_data[0].keys())
+        except (IndexError, TypeError):
+            pass
+        # 其他事件（例如重命名标签、删除作者）影响的书籍范围未知，需要全量刷新
+        return None
+
+
+class BookIds:
+    """全部书籍ID的有序向量（从新到旧），书库发生增删时才重新生成"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.version = 0
+        self.ids = array("i")
+        self.ascending = array("i")  # 从旧到新，供按ID升序分页使用
+        self.idset = frozenset()
+
+    def refresh(self):
+        idset = frozenset(self.cache.all_book_ids())
+        ids = array("i", sorted(idset, reverse=True))
+        ascending = array("i", reversed(ids))
+        # 整体替换引用，读取方无需加锁
+        self.ids, self.ascending, self.idset = ids, ascending, idset
+        self.version += 1
+
+    def on_library_changed(self, book_ids):
+        if book_ids is not None:
+            existing = self.cache.all_book_ids()
+            if all((i in existing) == (i in self.idset) for i in book_ids):
+                # 仅修改了元数据，书籍集合没有变化
+                return
+        self.refresh()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sample(self, k, population=None):
+        """随机抽取k本书；population限定在最新的若干本书中抽取"""
+        ids = self.ids
+        n = len(ids) if population is None else min(population, len(ids))
+        return [ids[i] for i in random.sample(range(n), min(k, n))]
+
+
+class CategoryBooks:
+    """分类（标签、作者、丛书、出版社、评分）下的书籍ID列表，按评分、ID倒序预先排好
+
+    只缓存最近访问的MAX_ENTRIES个分类；书籍元数据变更时，失效相关分类。"""
+
+    MAX_ENTRIES = 512
+    FIELDS = ["tags", "authors", "series", "publisher", "rating"]
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (field, key) => (ids, ratings, idset)
+        self.generation = 0  # 每次失效时加1，加载期间发生过失效的结果不写入缓存
+
+    def make_key(self, field, name):
+        if field == "rating":
+            try:
+                return (field, int(name or 0))
+            except (TypeError, ValueError):
+                return (field, 0)
+        return (field, str(name).lower())
+
+    def load(self, field, name):
+        if field == "rating" and not name:
+            # 未评分的书籍
+            ids = [i for i, r in self.cache.all_field_for("rating", self.cache.all_book_ids()).items() if not r]
+        else:
+            item_id = self.cache.get_item_id(field, name)
+            ids = self.cache.books_for_field(field, item_id) if item_id else []
+        ratings = self.cache.all_field_for("rating", ids)
+        keys = sorted(((ratings.get(i) or 0, i) for i in ids), reverse=True)
+        return [i for r, i in keys], [r for r, i in keys]
+
+    def get_ranked(self, field, name):
+        """返回(ids, ratings)，两者一一对应"""
+        key = self.make_key(field, name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0], entry[1]
+            generation = self.generation
+        ids, ratings = self.load(field, key[1])
+        ids, ratings = array("i", ids), array("i", ratings)
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (ids, ratings, frozenset(ids))
+                while len(self.entries) > self.MAX_ENTRIES:
+                    self.entries.popitem(last=False)
+        return ids, ratings
+
+    def get(self, field, name):
+        return self.get_ranked(field, name)[0]
+
+    def on_library_changed(self, book_ids):
+        if book_ids is None:
+            with self.lock:
+                self.generation += 1
+                self.entries.clear()
+            return
+
+        # 书籍当前所属的分类，以及之前包含这些书籍的分类，都需要失效
+        keys = set()
+        for field in self.FIELDS:
+            for val in self.cache.all_field_for(field, book_ids).values():
+                if field == "rating" or not isinstance(val, (tuple, list)):
+                    val = [val]
+                keys.update(self.make_key(field, v) for v in val if field == "rating" or v)
+        with self.lock:
+            self.generation += 1
+            for key, (ids, ratings, idset) in list(self.entries.items()):
+                if key in keys or not idset.isdisjoint(book_ids):
+                    del self.entries[key]
+
+
+class CategoryCounts:
+    """分类统计（标签数量、评分分布、OPDS分类等）的缓存，书库版本号变化后自动失效"""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.lock = threading.Lock()
+        self.values = {}  # key => (version, value)
+
+    def get(self, key, loader):
+        version = self.watcher.version
+        with self.lock:
+            hit = self.values.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]
+        # 加载期间书库若再次变化，则缓存的是旧版本号，下次访问时会重新加载
+        value = loader()
+        with self.lock:
+            self.values[key] = (version, value)
+        return value
+
+
+class FormattedBooks:
+    """格式化后的书籍卡片/详情的LRU缓存
+
+    key为(kind, book_id, last_modified, urls)，书籍修改后last_modified变化，旧的数据自然不再命中。"""
+
+    MAX_ENTRIES = 4096
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key => payload
+        self.keys = {}  # book_id => set(key)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, book, urls, builder):
+        key = (kind, book["id"], book.get("last_modified"), urls)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(data)
+            self.misses += 1
+        data = builder()
+        with self.lock:
+            self.entries[key] = data
+            self.keys.setdefault(key[1], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.forget(self.entries.popitem(last=False)[0])
+        # 调用方可能会修改返回值，因此返回副本
+        return dict(data)
+
+    def forget(self, key):
+        keys = self.keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys[key[1]]
+
+    def invalidate(self, book_id):
+        with self.lock:
+            for key in self.keys.pop(int(book_id), ()):
+                self.entries.pop(key, None)
+
+    def on_library_changed(self, book_ids):
+        if book_ids is None:
+            with self.lock:
+                self.entries.clear()
+                self.keys.clear()
+            return
+        for book_id in book_ids:
+            self.invalidate(book_id)
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class FormatSizes:
+    """书籍各格式文件的大小（来自metadata.db的data表）
+
+    启动时一次性加载，书籍新增格式或者变更后按书籍增量刷新；读取时不访问calibre和文件系统。"""
+
+    SQL = "SELECT book, format, uncompressed_size FROM data"
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.sizes = {}  # book_id => {FMT: size}
+
+    def load(self, book_ids=None):
+        sql = self.SQL
+        if book_ids is not None:
+            sql += " WHERE book IN (%s)" % ",".join(str(int(i)) for i in book_ids)
+        sizes = {}
+        for book_id, fmt, size in self.cache.backend.conn.get(sql):
+            sizes.setdefault(book_id, {})[fmt.upper()] = size
+        return sizes
+
+    def refresh(self):
+        _ts = time.time()
+        sizes = self.load()
+        with self.lock:
+            self.sizes = sizes
+        logging.info("[%5d ms] load format sizes (count = %d)" % (int(1000 * (time.time() - _ts)), len(sizes)))
+
+    def update(self, book_ids):
+        book_ids = [int(i) for i in book_ids]
+        if not book_ids:
+            return
+        sizes = self.load(book_ids)
+        with self.lock:
+            for book_id in book_ids:
+                if book_id in sizes:
+                    self.sizes[book_id] = sizes[book_id]
+                else:
+                    self.sizes.pop(book_id, None)
+
+    def on_library_changed(self, book_ids):
+        if book_ids is None:
+            self.refresh()
+        else:
+            self.update(book_ids)
+
+    def size(self, book_id, fmt):
+        return self.sizes.get(int(book_id), {}).get(fmt.upper())
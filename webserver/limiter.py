@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+from collections import deque
+
+
+class DownloadLimiter:
+    """下载/推送次数的滑动窗口限制，在内存中统计，可定期保存到ipdownloads表以便重启后恢复
+
+    key为IP地址，或者"user:<用户ID>"。"""
+
+    def __init__(self, session_factory=None, window=86400, clock=time.time):
+        self.session_factory = session_factory  # 为None时不保存快照
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = {}  # key => deque(时间戳)
+
+    def expire(self, q, now):
+        while q and q[0] <= now - self.window:
+            q.popleft()
+
+    def acquire(self, limits):
+        """limits为[(key, limit)]；全部未超限时记录一次并返回None，否则返回超限的(key, limit)"""
+        limits = [(k, n) for k, n in limits if n > 0]
+        now = self.clock()
+        with self.lock:
+            for key, limit in limits:
+                q = self.hits.get(key)
+                if q is None:
+                    continue
+                self.expire(q, now)
+                if len(q) >= limit:
+                    return (key, limit)
+            for key, limit in limits:
+                self.hits.setdefault(key, deque()).append(now)
+        return None
+
+    def prune(self):
+        """清理已经过期的key，避免占用的内存无限增长"""
+        now = self.clock()
+        with self.lock:
+            for key in list(self.hits):
+                self.expire(self.hits[key], now)
+                if not self.hits[key]:
+                    del self.hits[key]
+
+    def restore(self):
+        if self.session_factory is None:
+            return
+        from webserver.models import IpDownloads
+
+        now = self.clock()
+        count = 0
+        session = self.session_factory()
+        try:
+            with self.lock:
+                for row in session.query(IpDownloads):
+                    if not row.starttime or not row.dcount:
+                        continue
+                    start = time.mktime(row.starttime.timetuple())
+                    if start <= now - self.window:
+                        continue
+                    # 快照中只保存了窗口内最早的时间和次数，恢复时按最早的时间处理
+                    self.hits[row.ip] = deque([start] * row.dcount)
+                    count += 1
+        finally:
+            session.close()
+        logging.info("restore download limits (count = %d)" % count)
+
+    def snapshot(self):
+        """用当前窗口内的数据替换ipdownloads表的内容"""
+        self.prune()
+        if self.session_factory is None:
+            return
+        from webserver.models import IpDownloads
+
+        with self.lock:
+            rows = [(k, q[0], len(q)) for k, q in self.hits.items() if q]
+        session = self.session_factory()
+        try:
+            session.query(IpDownloads).delete()
+            for key, start, count in rows:
+                row = IpDownloads()
+                row.ip = key
+                row.starttime = datetime.datetime.fromtimestamp(start)
+                row.dcount = count
+                session.add(row)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.warning("some err: %r" % e)
+        finally:
+            session.close()
@@ -4,9 +4,11 @@
 import logging
 import os
 import re
+import signal
 import sys
 from gettext import gettext as _
 
+import tornado.autoreload
 import tornado.httpserver
 import tornado.ioloop
 from social_tornado.models import init_social
@@ -16,6 +18,13 @@ from tornado import web
 from tornado.options import define, options
 
 from webserver import loader, models, social_routes, handlers
+from webserver.library import BookIds, CategoryBooks, CategoryCounts, FormatSizes, FormattedBooks, LibraryWatcher
+from webserver.limiter import DownloadLimiter
+from webserver.principals import CredentialCache, PrincipalCache
+from webserver.ranking import CounterBuffer, HotRanking
+from webserver.stats import SiteStats
+from webserver.thumbnails import ThumbnailCache, probe_formats
+from webserver.search import SearchIndex, SuggestIndex
 
 CONF = loader.get_settings()
 define("host", default="", type=str, help=_("The host address on which to listen"))
@@ -143,6 +152,8 @@ def make_app():
     # 创表或者新增表。
     models.user_syncdb(engine)
     logging.info("Create tables into DB")
+    models.migrate_reader_history(ScopedSession())
+    ScopedSession.remove()
 
     init_calibre()
 
@@ -171,14 +182,74 @@ def make_app():
 
     gui2.must_use_qt = new_must_use_qt
 
+    # 书库的内存索引，通过calibre的变更通知保持更新
+    watcher = LibraryWatcher()
+    book_ids = BookIds(cache)
+    book_ids.refresh()
+    watcher.subscribe(book_ids.on_library_changed)
+    category_books = CategoryBooks(cache)
+    watcher.subscribe(category_books.on_library_changed)
+    category_counts = CategoryCounts(watcher)
+    formatted_books = FormattedBooks()
+    watcher.subscribe(formatted_books.on_library_changed)
+    format_sizes = FormatSizes(cache)
+    format_sizes.refresh()
+    watcher.subscribe(format_sizes.on_library_changed)
+    search_index = SearchIndex(cache)
+    search_index.build()
+    watcher.subscribe(search_index.on_library_changed)
+    suggest_index = SuggestIndex(cache, pinyin=search_index.pinyin)
+    suggest_index.build()
+    watcher.subscribe(suggest_index.on_library_changed)
+    hot_ranking = HotRanking(cache)
+    hot_ranking.load(ScopedSession())
+    ScopedSession.remove()
+    watcher.subscribe(hot_ranking.on_library_changed)
+    counters = CounterBuffer(ScopedSession.session_factory, max_events=CONF["counter_flush_events"])
+    download_limiter = DownloadLimiter(ScopedSession.session_factory if CONF["downloads_limit_snapshot"] else None)
+    download_limiter.restore()
+    site_stats = SiteStats(book_db, ScopedSession.session_factory, counters)
+    principals = PrincipalCache()
+    credentials = CredentialCache()
+    watcher.subscribe(site_stats.on_library_changed)
+
     path = CONF["resource_path"] + "/calibre/default_cover.jpg"
     with open(path, "rb") as cover_file:
         default_cover = cover_file.read()
+    # 在处理请求之前确定Qt能够编码的图片格式
+    if CONF["cover_image_formats"]:
+        probe_formats()
+    thumbnails = ThumbnailCache(
+        cache,
+        CONF["thumbnail_path"],
+        default_cover,
+        os.stat(path).st_mtime,
+        max_bytes=parse_size(CONF["thumbnail_cache_size"]),
+        sizes=[tuple(int(v) for v in size.split("x")) for size in CONF["thumbnail_pregenerate"]],
+    )
+    thumbnails.load()
+    watcher.subscribe(thumbnails.on_library_changed)
+    watcher.attach(cache)
     app_settings = dict(CONF)
     app_settings.update(
         {
             "legacy": book_db,
             "cache": cache,
+            "watcher": watcher,
+            "book_ids": book_ids,
+            "category_books": category_books,
+            "category_counts": category_counts,
+            "formatted_books": formatted_books,
+            "format_sizes": format_sizes,
+            "search_index": search_index,
+            "suggest_index": suggest_index,
+            "hot_ranking": hot_ranking,
+            "counters": counters,
+            "download_limiter": download_limiter,
+            "site_stats": site_stats,
+            "principals": principals,
+            "credentials": credentials,
+            "thumbnails": thumbnails,
             "ScopedSession": ScopedSession,
             "build_time": fromtimestamp(os.stat(path).st_mtime),
             "default_cover": default_cover,
@@ -192,8 +263,13 @@ def make_app():
 
 
 def get_upload_size():
+    return parse_size(CONF["MAX_UPLOAD_SIZE"])
+
+
+def parse_size(s):
+    """把"100MB"之类的配置转换为字节数"""
     n = 1
-    s = CONF["MAX_UPLOAD_SIZE"].lower().strip()
+    s = s.lower().strip()
     if s.endswith("k") or s.endswith("kb"):
         n = 1024
         s = s.split("k")[0]
@@ -212,10 +288,40 @@ def main():
     app = make_app()
     http_server = tornado.httpserver.HTTPServer(app, xheaders=True, max_buffer_size=get_upload_size())
     http_server.listen(options.port, options.host)
-    tornado.ioloop.IOLoop.instance().start()
-    from flask.ext.sqlalchemy import _EngineDebuggingSignalEvents
 
-    _EngineDebuggingSignalEvents(app._engine, app.import_name).register()
+    # 定期把内存中的访问/下载计数、下载次数限制写入数据库，退出前再写入一次
+    counters = app.settings["counters"]
+    tornado.ioloop.PeriodicCallback(counters.flush, CONF["counter_flush_interval"] * 1000).start()
+    download_limiter = app.settings["download_limiter"]
+    tornado.ioloop.PeriodicCallback(download_limiter.snapshot, 300 * 1000).start()
+    site_stats = app.settings["site_stats"]
+    tornado.ioloop.PeriodicCallback(site_stats.refresh, CONF["site_stats_interval"] * 1000).start()
+    session_factory = app.settings["ScopedSession"].session_factory
+
+    def trim_history():
+        session = session_factory()
+        try:
+            models.trim_reader_history(session)
+        except Exception as e:
+            session.rollback()
+            logging.warning("some err: %r" % e)
+        finally:
+            session.close()
+
+    tornado.ioloop.PeriodicCallback(trim_history, CONF["history_trim_interval"] * 1000).start()
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    def on_signal(signum, frame):
+        logging.info("Got signal %d, stopping..." % signum)
+        ioloop.add_callback_from_signal(ioloop.stop)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    tornado.autoreload.add_reload_hook(counters.flush)
+    tornado.autoreload.add_reload_hook(download_limiter.snapshot)
+    ioloop.start()
+    counters.flush()
+    download_limiter.snapshot()
 
 
 if __name__ == "__main__":
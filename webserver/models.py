@@ -10,7 +10,7 @@ import time
 from gettext import gettext as _
 
 from social_sqlalchemy.storage import JSONType, SQLAlchemyMixin
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.orm import relationship
@@ -75,7 +75,71 @@ class MutableDict(Mutable, dict):
         return dict.__getitem__(self, key)
 
 
-class Reader(Base, SQLAlchemyMixin):
+class UserPermission:
+    """用户权限的判断，Reader和Principal共用"""
+
+    def has_permission(self, operation, default=True):
+        if operation.upper() in self.permission:
+            return False
+        if operation.lower() in self.permission:
+            return True
+        return default
+
+    def can_login(self):
+        return self.has_permission("l")
+
+    def can_delete(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权删除书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("d")
+
+    def can_edit(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权编辑书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("e")
+
+    def can_push(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权推送书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("p")
+
+    def can_read(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权在线阅读书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("r")
+
+    def can_save(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权下载书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("s")
+
+    def can_upload(self, check=False):
+        if check and not self.is_active():
+            raise web.HTTPError(403, reason=_(u"未激活账号无权上传书籍，请先登录注册邮箱激活账号。"))
+        return self.has_permission("u")
+
+    def can_view(self):
+        return self.has_permission("v")
+
+    def is_active(self):
+        return self.active
+
+    def is_admin(self):
+        return self.admin
+
+
+class Principal(UserPermission):
+    """用户权限信息的快照，可以在请求之间缓存"""
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.admin = user.admin
+        self.active = user.active
+        self.permission = user.permission or ""
+
+
+class Reader(Base, SQLAlchemyMixin, UserPermission):
     OVERSIZE_SHRINK_RATE = 0.8
     SQLITE_MAX_LENGTH = 32 * 1024.0
 
@@ -185,54 +249,32 @@ class Reader(Base, SQLAlchemyMixin):
             v.append(p)
         self.permission = "".join(sorted(v))
 
-    def has_permission(self, operation, default=True):
-        if operation.upper() in self.permission:
-            return False
-        if operation.lower() in self.permission:
-            return True
-        return default
-
-    def can_login(self):
-        return self.has_permission("l")
-
-    def can_delete(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权删除书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("d")
-
-    def can_edit(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权编辑书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("e")
 
-    def can_push(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权推送书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("p")
-
-    def can_read(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权在线阅读书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("r")
+class ReaderHistory(Base, SQLAlchemyMixin):
+    """用户的浏览、阅读、下载、推送、上传、收藏记录
 
-    def can_save(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权下载书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("s")
+    写入时只追加；同一本书的重复记录和超出保留条数的旧记录由trim_reader_history定期清理。"""
 
-    def can_upload(self, check=False):
-        if check and not self.is_active():
-            raise web.HTTPError(403, reason=_(u"未激活账号无权上传书籍，请先登录注册邮箱激活账号。"))
-        return self.has_permission("u")
+    __tablename__ = "reader_history"
+    __table_args__ = (
+        Index("ix_reader_history_time", "reader_id", "action", "time"),
+        Index("ix_reader_history_book", "reader_id", "action", "book_id"),
+    )
 
-    def can_view(self):
-        return self.has_permission("v")
+    MAX_PER_ACTION = 200  # 每个用户每种记录最多保留的条数
 
-    def is_active(self):
-        return self.active
+    id = Column(Integer, primary_key=True)
+    reader_id = Column(Integer, ForeignKey("readers.id"), nullable=False)
+    action = Column(String(32), nullable=False)  # visit_history, fav_history, ...
+    book_id = Column(Integer, nullable=False)
+    time = Column(DateTime, nullable=False)
 
-    def is_admin(self):
-        return self.admin
+    def __init__(self, reader_id, action, book_id, time=None):
+        super(ReaderHistory, self).__init__()
+        self.reader_id = reader_id
+        self.action = action
+        self.book_id = book_id
+        self.time = time or datetime.datetime.now()
 
 
 class Message(Base, SQLAlchemyMixin):
@@ -277,6 +319,22 @@ class Item(Base, SQLAlchemyMixin):
         self.collector_id = 1
 
 
+class ItemDaily(Base, SQLAlchemyMixin):
+    """每本书每天的热度分数，用于按日/周统计热度榜单"""
+
+    __tablename__ = "items_daily"
+
+    book_id = Column(Integer, default=0, primary_key=True)
+    day = Column(Integer, default=0, primary_key=True, index=True)  # date.toordinal()
+    score = Column(Integer, default=0, nullable=False)
+
+    def __init__(self, book_id, day):
+        super(ItemDaily, self).__init__()
+        self.book_id = book_id
+        self.day = day
+        self.score = 0
+
+
 class IpDownloads(Base, SQLAlchemyMixin):
     __tablename__ = "ipdownloads"
     ip = Column(String(32), default="", nullable=False, primary_key=True)
@@ -337,3 +395,69 @@ class ScanFile(Base, SQLAlchemyMixin):
 
 def user_syncdb(engine):
     Base.metadata.create_all(engine)
+
+
+MIGRATE_HISTORY_KEY = "migrate:reader_history"
+
+
+def migrate_reader_history(session):
+    """把旧版本保存在Reader.extra中的*_history列表迁移到reader_history表，完成后记录标记，只执行一次"""
+    if session.query(KeyValueStore).filter(KeyValueStore.key == MIGRATE_HISTORY_KEY).first():
+        return
+    count = 0
+    now = datetime.datetime.now()
+    for user in session.query(Reader):
+        keys = [k for k, v in (user.extra or {}).items() if k.endswith("_history") and isinstance(v, list)]
+        for action in keys:
+            ids = []
+            for book_id in user.extra[action]:
+                if isinstance(book_id, int) and book_id not in ids:
+                    ids.append(book_id)
+            # 列表中越靠前的越新；从旧到新写入，使id的顺序与时间一致
+            ids = ids[: ReaderHistory.MAX_PER_ACTION]
+            for idx in reversed(range(len(ids))):
+                session.add(ReaderHistory(user.id, action, ids[idx], now - datetime.timedelta(seconds=idx)))
+                count += 1
+            del user.extra[action]
+    marker = KeyValueStore()
+    marker.key = MIGRATE_HISTORY_KEY
+    marker.value = now.strftime("%Y-%m-%d %H:%M:%S")
+    session.add(marker)
+    if count:
+        logging.info("migrate reader history (count = %d)" % count)
+    session.commit()
+
+
+def trim_reader_history(session):
+    """删除同一本书的旧记录，以及每个用户每种记录中超出MAX_PER_ACTION条的旧记录"""
+    _ts = time.time()
+    count = 0
+    keys = (ReaderHistory.reader_id, ReaderHistory.action, ReaderHistory.book_id)
+    dups = session.query(*keys, func.max(ReaderHistory.id)).group_by(*keys).having(func.count(ReaderHistory.id) > 1)
+    for reader_id, action, book_id, newest in dups.all():
+        rows = session.query(ReaderHistory).filter(
+            ReaderHistory.reader_id == reader_id,
+            ReaderHistory.action == action,
+            ReaderHistory.book_id == book_id,
+            ReaderHistory.id < newest,
+        )
+        count += rows.delete(synchronize_session=False)
+
+    groups = (
+        session.query(ReaderHistory.reader_id, ReaderHistory.action)
+        .group_by(ReaderHistory.reader_id, ReaderHistory.action)
+        .having(func.count(ReaderHistory.id) > ReaderHistory.MAX_PER_ACTION)
+        .all()
+    )
+    for reader_id, action in groups:
+        rows = session.query(ReaderHistory).filter(ReaderHistory.reader_id == reader_id, ReaderHistory.action == action)
+        oldest = (
+            rows.with_entities(ReaderHistory.id)
+            .order_by(ReaderHistory.id.desc())
+            .offset(ReaderHistory.MAX_PER_ACTION - 1)
+            .limit(1)
+            .scalar()
+        )
+        count += rows.filter(ReaderHistory.id < oldest).delete(synchronize_session=False)
+    session.commit()
+    logging.info("[%5d ms] trim reader history (count = %d)" % (int(1000 * (time.time() - _ts)), count))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+
+class PrincipalCache:
+    """已登录用户的权限信息缓存，避免每个请求都查询readers表
+
+    管理员修改用户、用户修改自己的信息后需要调用invalidate；多进程部署时，其他进程最多延迟ttl秒生效。"""
+
+    def __init__(self, ttl=60, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}  # user_id => (expire_time, principal)
+
+    def get(self, session, user_id):
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(user_id)
+        if entry and entry[0] > now:
+            return entry[1]
+        principal = self.load(session, user_id)
+        if principal is not None:
+            # 不缓存不存在的用户，新注册的用户可以立即生效
+            with self.lock:
+                self.entries[user_id] = (now + self.ttl, principal)
+        return principal
+
+    def load(self, session, user_id):
+        from webserver.models import Principal, Reader
+
+        user = session.query(Reader).get(user_id)
+        return Principal(user) if user else None
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(int(user_id), None)
+
+
+class CredentialCache:
+    """HTTP Basic认证中已经验证通过的用户名和密码
+
+    OPDS阅读器每个请求都会带上Authorization头，命中缓存时不再查询数据库和计算密码哈希。
+    缓存中只保存用进程内随机密钥计算的HMAC，不保存密码原文。"""
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self, ttl=300, touch_interval=300, clock=time.time):
+        self.ttl = ttl
+        self.touch_interval = touch_interval  # 同一用户的登录时间最多每隔N秒写入一次数据库
+        self.clock = clock
+        self.secret = os.urandom(32)
+        self.lock = threading.Lock()
+        self.entries = {}  # digest => (expire_time, user_id)
+        self.touched = {}  # user_id => 上次写入登录时间的时间
+
+    def digest(self, username, password):
+        msg = ("%s:%s" % (username, password)).encode("UTF-8")
+        return hmac.new(self.secret, msg, hashlib.sha256).hexdigest()
+
+    def get(self, username, password):
+        """返回已验证的用户ID，未命中时返回None"""
+        key = self.digest(username, password)
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+            self.entries.pop(key, None)
+        return None
+
+    def add(self, username, password, user_id):
+        key = self.digest(username, password)
+        now = self.clock()
+        with self.lock:
+            if len(self.entries) >= self.MAX_ENTRIES:
+                for k in [k for k, v in self.entries.items() if v[0] <= now]:
+                    del self.entries[k]
+                if len(self.entries) >= self.MAX_ENTRIES:
+                    self.entries.clear()
+            self.entries[key] = (now + self.ttl, user_id)
+
+    def should_touch(self, user_id):
+        """距离上次写入登录时间超过touch_interval时返回True，并记录本次写入"""
+        now = self.clock()
+        with self.lock:
+            if self.touched.get(user_id, 0) > now - self.touch_interval:
+                return False
+            self.touched[user_id] = now
+            return True
+
+    def invalidate(self, user_id=None):
+        """用户修改密码、被删除后调用"""
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+                return
+            user_id = int(user_id)
+            for k in [k for k, v in self.entries.items() if v[1] == user_id]:
+                del self.entries[k]
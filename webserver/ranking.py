@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+
+def today():
+    return datetime.date.today().toordinal()
+
+
+def hot_score(visit, download):
+    return visit * 2 + download
+
+
+class HotRanking:
+    """热度榜单：在内存中维护各时间窗口的分数，以及排名前TOP_N的书籍
+
+    分数随访问/下载计数增量更新，读取榜单只需切片，不再对items表做表达式排序。"""
+
+    TOP_N = 120
+    WINDOWS = {"day": 1, "week": 7, "all": None}
+
+    def __init__(self, cache, clock=today):
+        self.cache = cache
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.day = clock()
+        self.version = 0  # 榜单顺序变化时递增
+        self.visits = {}  # book_id => 累计访问次数（全站榜要求访问超过1次）
+        self.daily = {}  # day => {book_id: score}
+        self.scores = dict((w, {}) for w in self.WINDOWS)
+        self.tops = dict((w, []) for w in self.WINDOWS)
+
+    def load(self, session):
+        from webserver.models import Item, ItemDaily
+
+        _ts = time.time()
+        existing = self.cache.all_book_ids()
+        with self.lock:
+            self.day = self.clock()
+            first_day = self.day - max(n for n in self.WINDOWS.values() if n) + 1
+            for book_id, visit, download in session.query(Item.book_id, Item.count_visit, Item.count_download):
+                if book_id in existing:
+                    self.visits[book_id] = visit
+                    self.scores["all"][book_id] = hot_score(visit, download)
+            for row in session.query(ItemDaily).filter(ItemDaily.day >= first_day):
+                if row.book_id in existing:
+                    self.daily.setdefault(row.day, {})[row.book_id] = row.score
+            self.rollover(force=True)
+        logging.info("[%5d ms] load hot ranking (count = %d)" % (int(1000 * (time.time() - _ts)), len(self.visits)))
+
+        # 清理时间窗口之外的历史数据
+        try:
+            session.query(ItemDaily).filter(ItemDaily.day < first_day).delete()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.warning("some err: %r" % e)
+
+    def eligible(self, window, book_id):
+        if window == "all":
+            return self.visits.get(book_id, 0) > 1
+        return self.scores[window].get(book_id, 0) > 0
+
+    def rank_key(self, window):
+        scores = self.scores[window]
+        return lambda book_id: (scores.get(book_id, 0), book_id)
+
+    def rebuild(self, window):
+        ids = [k for k in self.scores[window] if self.eligible(window, k)]
+        self.tops[window] = heapq.nlargest(self.TOP_N, ids, key=self.rank_key(window))
+        self.version += 1
+
+    def rollover(self, force=False):
+        """跨天后，重新汇总day/week窗口的分数"""
+        day = self.clock()
+        if day == self.day and not force:
+            return
+        self.day = day
+        for window, days in self.WINDOWS.items():
+            if not days:
+                continue
+            scores = {}
+            for d in range(day - days + 1, day + 1):
+                for book_id, score in self.daily.get(d, {}).items():
+                    scores[book_id] = scores.get(book_id, 0) + score
+            self.scores[window] = scores
+        oldest = day - max(n for n in self.WINDOWS.values() if n) + 1
+        for d in [d for d in self.daily if d < oldest]:
+            del self.daily[d]
+        for window in self.WINDOWS:
+            self.rebuild(window)
+
+    def promote(self, window, book_id):
+        if not self.eligible(window, book_id):
+            return
+        top = self.tops[window]
+        key = self.rank_key(window)
+        before = list(top)
+        if book_id not in top:
+            if len(top) >= self.TOP_N and key(book_id) <= key(top[-1]):
+                return
+            top.append(book_id)
+        top.sort(key=key, reverse=True)
+        del top[self.TOP_N:]
+        if top != before:
+            self.version += 1
+
+    def increase(self, book_id, visit=0, download=0):
+        score = hot_score(visit, download)
+        if score <= 0:
+            return
+        with self.lock:
+            self.rollover()
+            self.visits[book_id] = self.visits.get(book_id, 0) + visit
+            daily = self.daily.setdefault(self.day, {})
+            daily[book_id] = daily.get(book_id, 0) + score
+            for window in self.WINDOWS:
+                scores = self.scores[window]
+                scores[book_id] = scores.get(book_id, 0) + score
+                self.promote(window, book_id)
+
+    def on_library_changed(self, book_ids):
+        existing = self.cache.all_book_ids()
+        with self.lock:
+            if book_ids is None:
+                book_ids = set(self.visits)
+                for scores in self.scores.values():
+                    book_ids.update(scores)
+            removed = [i for i in book_ids if i not in existing]
+            if not removed:
+                return
+            for book_id in removed:
+                self.visits.pop(book_id, None)
+                for scores in list(self.scores.values()) + list(self.daily.values()):
+                    scores.pop(book_id, None)
+            for window in self.WINDOWS:
+                self.rebuild(window)
+
+    def top(self, window="all"):
+        with self.lock:
+            self.rollover()
+            return list(self.tops[window])
+
+    def ranked(self, window="all"):
+        """返回榜单的 [(score, book_id)]"""
+        with self.lock:
+            self.rollover()
+            scores = self.scores[window]
+            return [(scores.get(i, 0), i) for i in self.tops[window]]
+
+
+class CounterBuffer:
+    """访问/下载计数的写缓冲
+
+    计数先在内存中累加，每隔一段时间或者累计一定次数后，在一个事务中批量写入items、items_daily和access_statis表。
+    读取计数时需要合并尚未写入的部分。"""
+
+    FIELDS = ("count_guest", "count_visit", "count_download")
+
+    def __init__(self, session_factory, max_events=100, clock=today):
+        self.session_factory = session_factory
+        self.max_events = max_events
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flushed = {"visit": 0, "download": 0}  # 启动以来已经写入数据库的总数
+        self.reset()
+
+    def reset(self):
+        self.items = {}  # book_id => [guest, visit, download]
+        self.daily = {}  # (book_id, day) => score
+        self.totals = {"visit": 0, "download": 0}
+        self.events = 0
+
+    def add(self, book_id, guest=0, visit=0, download=0):
+        book_id = int(book_id)
+        with self.lock:
+            v = self.items.setdefault(book_id, [0, 0, 0])
+            v[0] += guest
+            v[1] += visit
+            v[2] += download
+            score = hot_score(visit, download)
+            if score > 0:
+                key = (book_id, self.clock())
+                self.daily[key] = self.daily.get(key, 0) + score
+            self.totals["visit"] += visit
+            self.totals["download"] += download
+            self.events += 1
+            full = self.events >= self.max_events
+        if full:
+            self.flush()
+
+    def pending(self, book_id):
+        """尚未写入数据库的计数 {field: delta}"""
+        v = self.items.get(int(book_id))
+        return dict(zip(self.FIELDS, v)) if v else {}
+
+    def pending_total(self, key):
+        return self.totals.get(key, 0)
+
+    def discard(self, book_id):
+        """书籍被删除后，丢弃尚未写入的计数"""
+        book_id = int(book_id)
+        with self.lock:
+            self.items.pop(book_id, None)
+            for key in [k for k in self.daily if k[0] == book_id]:
+                del self.daily[key]
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.events:
+                    return
+                items, daily, totals = self.items, self.daily, self.totals
+                self.reset()
+            try:
+                self.write(items, daily, totals)
+                with self.lock:
+                    for key, n in totals.items():
+                        self.flushed[key] += n
+            except Exception as e:
+                logging.warning("some err: %r" % e)
+                # 写入失败时放回缓冲区，下次再试
+                with self.lock:
+                    for book_id, v in items.items():
+                        p = self.items.setdefault(book_id, [0, 0, 0])
+                        for i in range(3):
+                            p[i] += v[i]
+                    for key, score in daily.items():
+                        self.daily[key] = self.daily.get(key, 0) + score
+                    for key, n in totals.items():
+                        self.totals[key] += n
+                    self.events += len(items)
+
+    def write(self, items, daily, totals):
+        from webserver.models import Item, ItemDaily, KeyValueStore
+
+        _ts = time.time()
+        session = self.session_factory()
+        try:
+            rows = dict((i.book_id, i) for i in session.query(Item).filter(Item.book_id.in_(list(items))))
+            for book_id, (g, v, d) in items.items():
+                item = rows.get(book_id)
+                if item is None:
+                    item = Item()
+                    item.book_id = book_id
+                    session.add(item)
+                item.count_guest += g
+                item.count_visit += v
+                item.count_download += d
+
+            for (book_id, day), score in daily.items():
+                row = session.query(ItemDaily).filter(ItemDaily.book_id == book_id, ItemDaily.day == day).first()
+                if row is None:
+                    row = ItemDaily(book_id, day)
+                    session.add(row)
+                row.score += score
+
+            for key, n in totals.items():
+                if n <= 0:
+                    continue
+                s = session.query(KeyValueStore).filter(KeyValueStore.key == key).first()
+                if s is None:
+                    s = KeyValueStore()
+                    s.key = key
+                    s.value = "0"
+                    session.add(s)
+                s.value = str(int(s.value) + n)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        logging.info("[%5d ms] flush counters (books = %d)" % (int(1000 * (time.time() - _ts)), len(items)))
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import bisect
+import logging
+import re
+import threading
+import time
+
+CJK_CHARS = u"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+TOKEN_RE = re.compile(u"[%s]+|[^\\W_%s]+" % (CJK_CHARS, CJK_CHARS))
+CJK_RE = re.compile(u"[%s]" % CJK_CHARS)
+PINYIN_RE = re.compile(r"^[a-z]+$")
+
+# 拼音索引为汉字词的每个后缀都生成拼音，过长的词只取前面一段
+PINYIN_MAX_CHARS = 16
+
+# 参与检索的字段，以及各字段在相关度排序中的权重
+SEARCH_FIELDS = [
+    ("title", 8),
+    ("authors", 4),
+    ("tags", 2),
+    ("series", 1),
+]
+
+# 匹配质量：完全相同 > 前缀匹配 > 包含
+MATCH_EXACT = 3
+MATCH_PREFIX = 2
+MATCH_CONTAINS = 1
+
+
+def tokenize(text):
+    """将字段值拆分为小写的词：连续的汉字为一个词，其余按非字母数字切分"""
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+def is_cjk(word):
+    return CJK_RE.match(word) is not None
+
+
+def ngrams(word, n=2):
+    return set(word[i:i + n] for i in range(len(word) - n + 1))
+
+
+class Pinyin:
+    """借助calibre自带的unihandecode，将单个汉字转换为拼音"""
+
+    def __init__(self):
+        self.decoder = None
+        self.memo = {}
+        try:
+            from calibre.ebooks.unihandecode import Unihandecoder
+
+            self.decoder = Unihandecoder(lang="zh")
+        except ImportError:
+            logging.warning("unihandecode is not available, pinyin search is disabled")
+
+    def __call__(self, char):
+        if char not in self.memo:
+            v = self.decoder.decode(char) if self.decoder else ""
+            v = v.strip().lower()
+            self.memo[char] = v if PINYIN_RE.match(v) else ""
+        return self.memo[char]
+
+
+class SearchIndex:
+    """书名、作者、标签、丛书的内存倒排索引，替代逐字段调用calibre的search()"""
+
+    def __init__(self, cache, pinyin=None):
+        self.cache = cache
+        self.pinyin = pinyin or Pinyin()
+        self.lock = threading.RLock()
+        self.reset()
+
+    STRUCTURES = ("docs", "postings", "tokens", "grams", "pinyin_terms", "pinyin_list")
+
+    def reset(self):
+        self.docs = {}  # book_id => set(tokens)
+        self.postings = {}  # token => {book_id: weight}
+        self.tokens = []  # 有序的词表，用于前缀查找
+        self.grams = {}  # 汉字的单字和双字、其他词的三字母片段 => set(tokens)，用于包含匹配
+        self.pinyin_terms = {}  # 全拼或首字母 => {token: quality}
+        self.pinyin_list = []  # 有序的拼音词表
+
+    def build(self):
+        """在新的索引中读取全部书籍，完成后再替换，重建期间查询仍使用旧的索引"""
+        _ts = time.time()
+        index = SearchIndex(self.cache, pinyin=self.pinyin)
+        index.update(index.cache.all_book_ids())
+        with self.lock:
+            for name in self.STRUCTURES:
+                setattr(self, name, getattr(index, name))
+        logging.info("[%5d ms] build search index (count = %d)" % (int(1000 * (time.time() - _ts)), len(self.docs)))
+
+    def on_library_changed(self, book_ids):
+        if book_ids is None:
+            return self.build()
+        self.update(book_ids)
+
+    def read_books(self, book_ids):
+        existing = set(self.cache.all_book_ids())
+        book_ids = [i for i in book_ids if i in existing]
+        values = dict((f, self.cache.all_field_for(f, book_ids)) for f, _ in SEARCH_FIELDS)
+        books = {}
+        for book_id in book_ids:
+            books[book_id] = dict((f, values[f].get(book_id)) for f, _ in SEARCH_FIELDS)
+        return books
+
+    def update(self, book_ids):
+        books = self.read_books(book_ids)
+        with self.lock:
+            for book_id in book_ids:
+                self.remove_book(book_id)
+                if book_id in books:
+                    self.add_book(book_id, books[book_id])
+
+    def add_book(self, book_id, fields):
+        weights = {}
+        for field, weight in SEARCH_FIELDS:
+            val = fields.get(field)
+            if not val:
+                continue
+            if isinstance(val, (list, tuple)):
+                val = " ".join(val)
+            for t in set(tokenize(val)):
+                weights[t] = weights.get(t, 0) + weight
+
+        for t, weight in weights.items():
+            if t not in self.postings:
+                self.postings[t] = {}
+                bisect.insort(self.tokens, t)
+                self.add_grams(t)
+                if is_cjk(t):
+                    self.add_cjk_token(t)
+            self.postings[t][book_id] = weight
+        self.docs[book_id] = set(weights)
+
+    def gram_keys(self, token):
+        """汉字词取单字和双字；其他词取三字母片段，短于3个字母的词只能前缀匹配"""
+        if is_cjk(token):
+            return set(token) | ngrams(token)
+        return ngrams(token, 3)
+
+    def pinyin_keys(self, token):
+        """汉字词每个后缀的全拼和首字母，后缀从词首开始时视为前缀匹配"""
+        syllables = [self.pinyin(c) for c in token[:PINYIN_MAX_CHARS]]
+        keys = {}
+        for i in range(len(syllables)):
+            if not syllables[i]:
+                continue
+            quality = MATCH_PREFIX if i == 0 else MATCH_CONTAINS
+            for k in ("".join(syllables[i:]), "".join(v[:1] for v in syllables[i:])):
+                keys[k] = max(keys.get(k, 0), quality)
+        return keys
+
+    def add_grams(self, token):
+        for g in self.gram_keys(token):
+            self.grams.setdefault(g, set()).add(token)
+
+    def remove_grams(self, token):
+        for g in self.gram_keys(token):
+            tokens = self.grams.get(g, set())
+            tokens.discard(token)
+            if not tokens:
+                self.grams.pop(g, None)
+
+    def add_cjk_token(self, token):
+        for k, quality in self.pinyin_keys(token).items():
+            if k not in self.pinyin_terms:
+                self.pinyin_terms[k] = {}
+                bisect.insort(self.pinyin_list, k)
+            self.pinyin_terms[k][token] = quality
+
+    def remove_cjk_token(self, token):
+        for k in self.pinyin_keys(token):
+            tokens = self.pinyin_terms.get(k, {})
+            tokens.pop(token, None)
+            if not tokens:
+                self.pinyin_terms.pop(k, None)
+                self.remove_sorted(self.pinyin_list, k)
+
+    def remove_sorted(self, items, value):
+        idx = bisect.bisect_left(items, value)
+        if idx < len(items) and items[idx] == value:
+            del items[idx]
+
+    def remove_book(self, book_id):
+        for t in self.docs.pop(book_id, []):
+            books = self.postings[t]
+            books.pop(book_id, None)
+            if not books:
+                del self.postings[t]
+                self.remove_sorted(self.tokens, t)
+                self.remove_grams(t)
+                if is_cjk(t):
+                    self.remove_cjk_token(t)
+
+    def match_quality(self, token, word):
+        if token == word:
+            return MATCH_EXACT
+        if token.startswith(word):
+            return MATCH_PREFIX
+        return MATCH_CONTAINS
+
+    def match_infix_tokens(self, word):
+        """通过片段倒排表求交集找出包含word的词，避免扫描整个词表"""
+        if is_cjk(word):
+            keys = ngrams(word) if len(word) > 1 else set(word)
+        else:
+            keys = ngrams(word, 3)
+            if not keys:
+                return {}
+        candidates = None
+        for g in sorted(keys, key=lambda k: len(self.grams.get(k, ()))):
+            tokens = self.grams.get(g)
+            if not tokens:
+                return {}
+            candidates = set(tokens) if candidates is None else candidates & tokens
+        return dict((t, self.match_quality(t, word)) for t in candidates if word in t)
+
+    def match_pinyin_tokens(self, word):
+        """用全拼或首字母（例如hlm）匹配汉字词"""
+        matches = {}
+        idx = bisect.bisect_left(self.pinyin_list, word)
+        while idx < len(self.pinyin_list) and self.pinyin_list[idx].startswith(word):
+            k = self.pinyin_list[idx]
+            for t, quality in self.pinyin_terms[k].items():
+                if k == word and quality == MATCH_PREFIX:
+                    quality = MATCH_EXACT
+                matches[t] = max(matches.get(t, 0), quality)
+            idx += 1
+        return matches
+
+    def match_tokens(self, word, pinyin=False):
+        """返回包含word的所有词，以及对应的匹配质量"""
+        if is_cjk(word):
+            return self.match_infix_tokens(word)
+
+        matches = self.match_pinyin_tokens(word) if pinyin and PINYIN_RE.match(word) else {}
+        idx = bisect.bisect_left(self.tokens, word)
+        while idx < len(self.tokens) and self.tokens[idx].startswith(word):
+            t = self.tokens[idx]
+            matches[t] = self.match_quality(t, word)
+            idx += 1
+        for t, quality in self.match_infix_tokens(word).items():
+            matches[t] = max(matches.get(t, 0), quality)
+        return matches
+
+    def search(self, query, mode=""):
+        """返回匹配的书籍ID列表，按相关度从高到低排序（相同时新书在前）
+
+        mode为pinyin时，纯字母的关键字还会按拼音全拼/首字母匹配汉字"""
+        scores = self.search_scores(query, mode)
+        return sorted(scores, key=lambda k: (scores[k], k), reverse=True)
+
+    def search_scores(self, query, mode=""):
+        """返回 {book_id: 相关度}"""
+        pinyin = mode == "pinyin"
+        words = tokenize(query)
+        if not words:
+            return {}
+
+        scores = None
+        with self.lock:
+            for word in set(words):
+                hits = {}
+                for t, quality in self.match_tokens(word, pinyin).items():
+                    for book_id, weight in self.postings[t].items():
+                        hits[book_id] = max(hits.get(book_id, 0), quality * weight)
+                if scores is None:
+                    scores = hits
+                else:
+                    # 多个关键字时，要求全部命中
+                    scores = dict((k, v + hits[k]) for k, v in scores.items() if k in hits)
+                if not scores:
+                    return {}
+        return scores
+
+
+# 输入提示的数据来源、返回给前端的类型（与/api/<meta>/<name>一致），以及展示时的先后顺序
+SUGGEST_FIELDS = [
+    ("title", "title", 0),
+    ("authors", "author", 1),
+    ("series", "series", 2),
+    ("tags", "tag", 3),
+]
+
+
+class SuggestIndex:
+    """书名、作者、丛书、标签的有序前缀表，用于输入框的实时提示
+
+    每个提示项记录引用它的书籍数量，书籍修改或删除时只增删差异部分，计数为0时移除。"""
+
+    def __init__(self, cache, pinyin=None):
+        self.cache = cache
+        self.pinyin = pinyin or Pinyin()
+        self.lock = threading.RLock()
+        self.entries = []  # 有序的 (key, priority, name, meta)
+        self.refs = {}  # (key, priority, name, meta) => 引用的书籍数量
+        self.books = {}  # book_id => set(提示项)
+
+    def build(self):
+        _ts = time.time()
+        book_ids = self.cache.all_book_ids()
+        books = self.read_books(book_ids)
+        refs = {}
+        for items in books.values():
+            for item in items:
+                refs[item] = refs.get(item, 0) + 1
+        with self.lock:
+            self.books = books
+            self.refs = refs
+            self.entries = sorted(refs)
+        logging.info("[%5d ms] build suggest index (count = %d)" % (int(1000 * (time.time() - _ts)), len(refs)))
+
+    def make_entries(self, name, meta, priority):
+        if not name:
+            return []
+        keys = set([name.lower()])
+        if CJK_RE.search(name):
+            syllables = [self.pinyin(c) for c in name[:PINYIN_MAX_CHARS] if is_cjk(c)]
+            if all(syllables):
+                keys.add("".join(syllables))
+                keys.add("".join(v[0] for v in syllables))
+        return [(k, priority, name, meta) for k in keys if k]
+
+    def read_books(self, book_ids):
+        """返回 {book_id: set(提示项)}，不存在的书籍不在结果中"""
+        book_ids = list(book_ids)
+        books = {}
+        for field, meta, priority in SUGGEST_FIELDS:
+            for book_id, val in self.cache.all_field_for(field, book_ids).items():
+                names = val if isinstance(val, (list, tuple)) else [val]
+                items = books.setdefault(book_id, set())
+                for name in names:
+                    items.update(self.make_entries(name, meta, priority))
+        return books
+
+    def update(self, book_ids):
+        """书籍新增、修改或删除后，按新旧提示项的差异更新提示表"""
+        existing = self.cache.all_book_ids()
+        book_ids = set(book_ids)
+        books = self.read_books(i for i in book_ids if i in existing)
+        with self.lock:
+            for book_id in book_ids:
+                old = self.books.pop(book_id, set())
+                new = books.get(book_id, set())
+                if new:
+                    self.books[book_id] = new
+                for item in old - new:
+                    self.refs[item] -= 1
+                    if not self.refs[item]:
+                        del self.refs[item]
+                        idx = bisect.bisect_left(self.entries, item)
+                        if idx < len(self.entries) and self.entries[idx] == item:
+                            del self.entries[idx]
+                for item in new - old:
+                    if item not in self.refs:
+                        self.refs[item] = 0
+                        bisect.insort(self.entries, item)
+                    self.refs[item] += 1
+
+    def on_library_changed(self, book_ids):
+        if book_ids is None:
+            return self.build()
+        self.update(book_ids)
+
+    def suggest(self, query, limit=10):
+        q = query.strip().lower()
+        if not q:
+            return []
+
+        found = {}
+        with self.lock:
+            idx = bisect.bisect_left(self.entries, (q,))
+            # 只查看有限个候选项，保证每次按键都能快速返回
+            end = min(len(self.entries), idx + limit * 20)
+            while idx < end and self.entries[idx][0].startswith(q):
+                _, priority, name, meta = self.entries[idx]
+                found[(meta, name)] = priority
+                idx += 1
+        items = sorted(found.items(), key=lambda x: (x[1], len(x[0][1]), x[0][1]))
+        return [{"type": meta, "name": name} for (meta, name), _ in items[:limit]]
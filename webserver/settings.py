@@ -21,6 +21,7 @@ settings = {
     "upload_path"   : "/data/books/upload/",
     "scan_upload_path"   : "/data/books/imports/",
     "extract_path"  : "/data/books/extract/",
+    "thumbnail_path": "/data/books/thumbnails/",
     "with_library"  : "/data/books/library/",
     "cookie_secret" : "cookie_secret",
     "cookie_expire" : 7*86400,
@@ -41,6 +42,29 @@ settings = {
     "opds_url_prefix"          : "",
 
     "downloads_count_per_ip_limitation": 0,
+    "downloads_count_per_user_limitation": 0,
+    # 下载次数限制的统计保存在内存中，定期保存到数据库，重启后恢复
+    "downloads_limit_snapshot": True,
+    # 书籍文件交给nginx发送：鉴权和计数之后返回X-Accel-Redirect头，值为nginx中对应with_library的internal location，
+    # 例如"/_library/"（见conf/nginx/talebook.conf）；为空时由tornado自己发送
+    "download_accel_redirect": "",
+
+    # 访问/下载计数的写缓冲：每隔N秒或者累计N次后批量写入数据库
+    "counter_flush_interval": 10,
+    "counter_flush_events": 100,
+
+    # 站点统计（用户数、访问量等）的后台刷新间隔，单位秒
+    "site_stats_interval": 60,
+
+    # 用户浏览/下载等记录只追加写入，每隔N秒清理重复和超出保留条数的旧记录
+    "history_trim_interval": 3600,
+
+    # 封面缩略图磁盘缓存的大小上限，超过后删除最久未使用的文件
+    "thumbnail_cache_size": "512MB",
+    # 新增书籍或者封面变化时，预先生成这些尺寸的缩略图，例如 ["60x80"]
+    "thumbnail_pregenerate": [],
+    # 封面和缩略图按照请求的Accept头返回更小的格式，按顺序优先；需要calibre的Qt支持对应的格式，为空时只返回JPEG
+    "cover_image_formats": ["avif", "webp"],
     "db_engine_args": {
         "echo": False,
     },
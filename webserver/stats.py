@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+
+
+class SiteStats:
+    """站点统计数据的快照，供/api/user/info和页面模板读取，请求时不再查询数据库
+
+    书库相关的数量在书库变化后重新计算；用户数和访问总数由定时任务在后台刷新。"""
+
+    def __init__(self, db, session_factory, counters):
+        self.db = db
+        self.session_factory = session_factory
+        self.counters = counters
+        self.lock = threading.Lock()
+        self.library = None
+        self.library_version = 0  # 书库变化时加1，计算期间书库发生变化的结果不保存
+        self.users = None
+
+    def on_library_changed(self, book_ids):
+        with self.lock:
+            self.library = None
+            self.library_version += 1
+
+    def load_library(self):
+        db = self.db
+        return {
+            "books": db.count(),
+            "tags": len(db.all_tags()),
+            "authors": len(db.all_authors()),
+            "publishers": len(db.all_publishers()),
+            "series": len(db.all_series()),
+            "mtime": db.last_modified().strftime("%Y-%m-%d"),
+        }
+
+    def load_users(self):
+        from sqlalchemy import func
+
+        from webserver.models import KeyValueStore, Reader
+
+        last_week = datetime.datetime.now() - datetime.timedelta(days=7)
+        session = self.session_factory()
+        try:
+            d = {
+                "users": session.query(func.count(Reader.id)).scalar(),
+                "active": session.query(func.count(Reader.id)).filter(Reader.access_time > last_week).scalar(),
+                "visit": 0,
+                "download": 0,
+            }
+            rows = session.query(KeyValueStore.key, KeyValueStore.value).filter(KeyValueStore.key.in_(["visit", "download"]))
+            for key, value in rows:
+                d[key] = int(value)
+        finally:
+            session.close()
+        return d
+
+    def refresh(self):
+        _ts = time.time()
+        try:
+            # 读取期间不允许写入计数，保证数据库中的总数与counters.flushed一致
+            with self.counters.flush_lock:
+                users = self.load_users()
+                flushed = dict(self.counters.flushed)
+        except Exception as e:
+            logging.warning("some err: %r" % e)
+            with self.lock:
+                if self.users is None:
+                    self.users = {"users": 0, "active": 0, "visit": 0, "download": 0}
+            return
+        # 之后写入数据库的计数由counters.flushed补上
+        for key in ("visit", "download"):
+            users[key] -= flushed[key]
+        with self.lock:
+            self.users = users
+        logging.debug("[%5d ms] refresh site stats" % int(1000 * (time.time() - _ts)))
+
+    def get(self):
+        with self.lock:
+            library, users, version = self.library, self.users, self.library_version
+        if library is None:
+            library = self.load_library()
+            with self.lock:
+                if version == self.library_version:
+                    self.library = library
+        if users is None:
+            self.refresh()
+            with self.lock:
+                users = self.users
+        d = dict(library)
+        d.update(users)
+        d["readcount"] = d.pop("visit") + self.counters.flushed["visit"] + self.counters.pending_total("visit")
+        d["downloadcount"] = d.pop("download") + self.counters.flushed["download"] + self.counters.pending_total("download")
+        return d
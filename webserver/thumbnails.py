@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+IMAGE_TYPES = {"jpg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+
+_writable_formats = None
+
+
+def probe_formats():
+    """启动时检查calibre使用的Qt能够编码的图片格式，WebP/AVIF需要安装对应的Qt插件
+
+    只使用calibre.utils.img中的图片处理功能，不创建QApplication"""
+    global _writable_formats
+    formats = set()
+    try:
+        import calibre.utils.img  # noqa: F401 加载calibre配置好的Qt环境
+
+        try:
+            from qt.core import QImageWriter
+        except ImportError:
+            from PyQt5.QtGui import QImageWriter
+        formats = set(bytes(f).decode("ascii").lower() for f in QImageWriter.supportedImageFormats())
+    except Exception as e:
+        logging.warning("some err: %r" % e)
+    formats.add("jpg")
+    _writable_formats = formats
+    logging.info("writable image formats: %s" % ", ".join(sorted(formats)))
+    return formats
+
+
+def writable_formats():
+    # 未检查过时只使用jpg，不在处理请求的线程中加载Qt
+    return _writable_formats or {"jpg"}
+
+
+def parse_accept(accept):
+    """返回 {媒体类型: q值}"""
+    types = {}
+    for part in accept.split(","):
+        params = part.strip().split(";")
+        q = 1.0
+        for p in params[1:]:
+            k, _, v = p.strip().partition("=")
+            if k.strip() == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        types[params[0].strip().lower()] = q
+    return types
+
+
+def negotiate_format(accept, candidates):
+    """按candidates的顺序，返回客户端明确接受（q>0）并且能够编码的第一个格式，都不支持时返回jpg"""
+    types = parse_accept(accept)
+    for fmt in candidates:
+        if types.get(IMAGE_TYPES.get(fmt, "-"), 0) > 0 and fmt in writable_formats():
+            return fmt
+    return "jpg"
+
+
+SPRITE_COLUMNS = 10  # 拼图每行的缩略图数量，前端按相同的规则计算位置
+
+
+def sprite_layout(count):
+    """返回拼图的(列数, 行数)；第i张缩略图位于第i % 列数列、第i // 列数行"""
+    columns = max(1, min(SPRITE_COLUMNS, count))
+    return columns, (count + columns - 1) // columns
+
+
+def make_sprite(thumbs, width, height, fmt="jpg"):
+    """把多张缩略图按sprite_layout拼成一张图片，每张居中放在width x height的格子里"""
+    from calibre.utils.img import create_canvas, image_from_data, image_to_data, overlay_image
+
+    columns, rows = sprite_layout(len(thumbs))
+    canvas = create_canvas(columns * width, rows * height)
+    for idx, data in enumerate(thumbs):
+        img = image_from_data(data)
+        left = (idx % columns) * width + max(0, width - img.width()) // 2
+        top = (idx // columns) * height + max(0, height - img.height()) // 2
+        overlay_image(img, canvas, left, top)
+    return image_to_data(canvas, fmt="JPEG" if fmt == "jpg" else fmt.upper())
+
+
+def make_thumbnail(cover, width, height, fmt="jpg"):
+    """width和height为0时保持原始尺寸，只转换格式"""
+    if not width and not height:
+        from calibre.utils.img import image_from_data, image_to_data
+
+        return image_to_data(image_from_data(cover), fmt="JPEG" if fmt == "jpg" else fmt.upper())
+
+    from calibre.utils.magick.draw import thumbnail as generate_thumbnail
+
+    return generate_thumbnail(cover, width=width, height=height, fmt=fmt)[-1]
+
+
+class ThumbnailCache:
+    """封面缩略图的磁盘缓存
+
+    文件名由(book_id, 宽, 高, 封面修改时间, 格式)计算得到，封面更新后自动使用新的文件；
+    总大小超过max_bytes时，按最近使用的顺序删除旧文件。book_id为0表示默认封面。"""
+
+    TOUCH_INTERVAL = 3600  # 命中时，文件修改时间早于此间隔才更新，运行期间的使用顺序由self.files维护
+
+    def __init__(self, cache, path, default_cover, default_mtime, max_bytes=512 * 1024 * 1024, sizes=()):
+        self.cache = cache
+        self.path = path
+        self.default_cover = default_cover
+        self.default_mtime = default_mtime
+        self.max_bytes = max_bytes
+        self.sizes = sizes  # 书籍新增或者封面变化时，预先生成的尺寸[(w, h)]
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # name => size，按最近使用的顺序排列
+        self.total = 0
+        self.enabled = False
+        self.pending = queue.Queue()  # 等待预先生成缩略图的书籍ID列表
+        self.worker = None
+
+    def load(self):
+        """扫描缓存目录，按文件修改时间恢复使用顺序；目录不可写时不使用磁盘缓存"""
+        _ts = time.time()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            logging.warning("thumbnail cache disabled: %r" % e)
+            return
+        files = []
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for f in os.scandir(sub.path):
+                if f.name.endswith(".tmp"):
+                    continue
+                st = f.stat()
+                files.append((st.st_mtime, f.name, st.st_size))
+        with self.lock:
+            self.files.clear()
+            self.total = 0
+            for _, name, size in sorted(files):
+                self.files[name] = size
+                self.total += size
+            self.enabled = True
+        self.evict()
+        logging.info(
+            "[%5d ms] load thumbnail cache (count = %d, size = %d)"
+            % (int(1000 * (time.time() - _ts)), len(self.files), self.total)
+        )
+
+    def make_name(self, book_id, width, height, mtime, fmt):
+        key = "%d-%dx%d-%d" % (book_id, width, height, int(mtime))
+        return "%s.%s" % (hashlib.md5(key.encode("UTF-8")).hexdigest(), fmt)
+
+    def file_path(self, name):
+        return os.path.join(self.path, name[:2], name)
+
+    def cover_time(self, book_id):
+        """返回(实际使用的book_id, 封面修改时间)，没有封面时使用默认封面"""
+        updated = self.cache.cover_last_modified(book_id) if book_id else None
+        if updated is None:
+            return 0, self.default_mtime
+        return book_id, updated.timestamp()
+
+    def read(self, name):
+        """读取缓存的文件，不存在时返回None"""
+        with self.lock:
+            hit = name in self.files
+            if hit:
+                self.files.move_to_end(name)
+        if not hit:
+            return None
+        try:
+            path = self.file_path(name)
+            with open(path, "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+            # 更新修改时间，重启后load()按修改时间大致恢复最近使用的顺序
+            if time.time() - mtime > self.TOUCH_INTERVAL:
+                os.utime(path)
+            return data
+        except OSError:
+            self.forget(name)
+            return None
+
+    def get(self, book_id, width, height, fmt="jpg"):
+        book_id, mtime = self.cover_time(book_id)
+        name = self.make_name(book_id, width, height, mtime, fmt)
+        data = self.read(name)
+        if data is not None:
+            return data
+
+        cover = self.cache.cover(book_id) if book_id else None
+        data = make_thumbnail(cover or self.default_cover, width, height, fmt)
+        self.store(name, data)
+        return data
+
+    def store(self, name, data):
+        if not self.enabled:
+            return
+        path = self.file_path(name)
+        tmp = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("some err: %r" % e)
+            return
+        with self.lock:
+            self.total += len(data) - self.files.get(name, 0)
+            self.files[name] = len(data)
+        self.evict()
+
+    def forget(self, name):
+        with self.lock:
+            self.total -= self.files.pop(name, 0)
+
+    def evict(self):
+        removed = []
+        with self.lock:
+            while self.total > self.max_bytes and self.files:
+                name, size = self.files.popitem(last=False)
+                self.total -= size
+                removed.append(name)
+        for name in removed:
+            try:
+                os.remove(self.file_path(name))
+            except OSError:
+                pass
+
+    def sprite_name(self, book_ids, width, height, fmt="jpg"):
+        """由书籍ID列表、尺寸、格式以及每本书的封面修改时间计算，任意封面变化后名字也随之变化"""
+        versions = ",".join("%d=%d:%d" % ((i,) + self.cover_time(i)) for i in book_ids)
+        key = "sprite-%dx%d-%s" % (width, height, versions)
+        return "%s.%s" % (hashlib.md5(key.encode("UTF-8")).hexdigest(), fmt)
+
+    def get_sprite(self, name, book_ids, width, height, fmt="jpg"):
+        """多本书的缩略图拼图，与单张缩略图一起保存在磁盘缓存中"""
+        data = self.read(name)
+        if data is not None:
+            return data
+        # 拼图使用的单张缩略图同样来自缓存，与/get/thumb_WxH共用
+        thumbs = [self.get(book_id, width, height) for book_id in book_ids]
+        data = make_sprite(thumbs, width, height, fmt)
+        self.store(name, data)
+        return data
+
+    def pregenerate(self, book_ids):
+        for book_id in book_ids:
+            for width, height in self.sizes:
+                try:
+                    self.get(book_id, width, height)
+                except Exception as e:
+                    logging.warning("some err: %r" % e)
+
+    def run_worker(self):
+        while True:
+            book_ids = self.pending.get()
+            try:
+                self.pregenerate(book_ids)
+            finally:
+                self.pending.task_done()
+
+    def on_library_changed(self, book_ids):
+        # 缓存的文件名包含封面修改时间，不需要主动失效；这里只负责预先生成常用尺寸
+        if not book_ids or not self.sizes or not self.enabled:
+            return
+        with self.lock:
+            if self.worker is None:
+                # 只使用一个后台线程，依次处理书库的变化
+                self.worker = threading.Thread(target=self.run_worker, daemon=True)
+                self.worker.start()
+        self.pending.put(list(book_ids))
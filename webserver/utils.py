@@ -10,10 +10,11 @@ from gettext import gettext as _
 
 import PyPDF2
 from PyPDF2 import generic
+from sqlalchemy import func
 
 from webserver import constants
 from webserver.main import CONF
-from webserver.models import Item
+from webserver.models import Item, ReaderHistory
 from webserver.plugins.meta import douban, baike
 
 
@@ -41,6 +42,12 @@ class SimpleBookFormatter:
         return v
 
     def format(self):
+        data = self.format_meta()
+        data.update(self.format_extra())
+        return data
+
+    def format_meta(self):
+        """calibre中的元数据，书籍被修改之前不会变化"""
         b = self.book
         b["ts"] = b["last_modified"].strftime("%s")
         return {
@@ -61,7 +68,11 @@ class SimpleBookFormatter:
             "isbn": self.val("isbn", None),
             "img": self.cdn_url + "/get/cover/%(id)s.jpg?t=%(ts)s" % b,
             "thumb": self.cdn_url + "/get/thumb_60x80/%(id)s.jpg?t=%(ts)s" % b,
-            # 额外填充的字段
+        }
+
+    def format_extra(self):
+        """额外填充的字段（来自items表），随访问和下载而变化"""
+        return {
             "collector": self.get_collector(),
             "count_visit": self.val("count_visit", 0),
             "count_download": self.val("count_download", 0),
@@ -86,6 +97,7 @@ class BrefInfoFormatter(SimpleBookFormatter):
 class BookFormatter:
     def __init__(self, tornado_handler, calibre_book_item):
         self.db = tornado_handler.db
+        self.format_sizes = tornado_handler.format_sizes
         self.book = calibre_book_item
         self.cdn_url = tornado_handler.cdn_url
         self.api_url = tornado_handler.api_url
@@ -95,9 +107,8 @@ class BookFormatter:
         files = []
         book_id = self.book["id"]
         for fmt in self.book.get("available_formats", ""):
-            try:
-                filesize = self.db.sizeof_format(book_id, fmt, index_is_id=True)
-            except:
+            filesize = self.format_sizes.size(book_id, fmt)
+            if filesize is None:
                 continue
             item = {
                 "format": fmt,
@@ -115,24 +126,35 @@ class BookFormatter:
             "is_owner": h.is_admin() or h.is_book_owner(self.book["id"], h.user_id()),
         }
 
+    def cached(self, kind, builder):
+        cache = getattr(self.handler, "formatted_books", None)
+        if cache is None:
+            return builder()
+        return cache.get(kind, self.book, (self.cdn_url, self.api_url), builder)
+
     def format(self, with_files=False, with_perms=False, for_list_card=False):
         if for_list_card:
             f = BrefInfoFormatter(self.book, self.cdn_url)
-        else:
-            f = SimpleBookFormatter(self.book, self.cdn_url)
+            return self.cached("card", f.format)
 
-        data = f.format()
-        if not for_list_card:
+        f = SimpleBookFormatter(self.book, self.cdn_url)
+
+        def build():
+            data = f.format_meta()
             data.update(
                 {
                     "author_url": self.api_url + "/author/" + f.val("author_sort"),
                     "publisher_url": self.api_url + "/publisher/" + f.val("publisher"),
                 }
             )
-            if with_files:
-                data["files"] = self.get_files()
-            if with_perms:
-                data.update(self.get_permissions())
+            return data
+
+        data = self.cached("detail", build)
+        data.update(f.format_extra())
+        if with_files:
+            data["files"] = self.get_files()
+        if with_perms:
+            data.update(self.get_permissions())
         return data
 
 
@@ -198,17 +220,21 @@ def filter_tags(mi):
 
 
 def save_user_his(session, action, user, book_id):
-    extra = user.extra
-    history = extra.get(action, [])
-    if len(history) > 0:
-        for i in range(0, len(history)):
-            if history[i] == book_id:
-                history.pop(i)
-                break
-
-    history.insert(0, book_id)
-    extra[action] = history
-    user.extra.update(extra)
+    """追加一条用户行为记录；重复和超出保留条数的旧记录由models.trim_reader_history定期清理"""
+    session.add(ReaderHistory(user.id, action, book_id))
+    try:
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.warning("some err: %r" % e)
+
+
+def del_user_his(session, action, user_id, book_id=None):
+    """删除用户的某本书的记录；book_id为None时清空这类记录"""
+    rows = session.query(ReaderHistory).filter(ReaderHistory.reader_id == user_id, ReaderHistory.action == action)
+    if book_id is not None:
+        rows = rows.filter(ReaderHistory.book_id == book_id)
+    rows.delete(synchronize_session=False)
     try:
         session.commit()
     except Exception as e:
@@ -216,6 +242,36 @@ def save_user_his(session, action, user, book_id):
         logging.warning("some err: %r" % e)
 
 
+def has_user_his(session, action, user_id, book_id):
+    rows = session.query(ReaderHistory.id).filter(
+        ReaderHistory.reader_id == user_id, ReaderHistory.action == action, ReaderHistory.book_id == book_id
+    )
+    return rows.first() is not None
+
+
+def get_user_his(session, user_id, limit=100):
+    """返回{action: [book_id]}，按时间倒序，每类最多limit本；同一本书只取最近的一条"""
+    his = {}
+    rows = session.query(ReaderHistory.action, ReaderHistory.book_id).filter(ReaderHistory.reader_id == user_id)
+    for action, book_id in rows.order_by(ReaderHistory.time.desc(), ReaderHistory.id.desc()):
+        ids = his.setdefault(action, [])
+        if len(ids) < limit and book_id not in ids:
+            ids.append(book_id)
+    return his
+
+
+def count_user_his(session, user_ids):
+    """一次分组查询多个用户的记录数，返回{user_id: {action: 书籍数}}"""
+    counts = {}
+    if not user_ids:
+        return counts
+    rows = session.query(ReaderHistory.reader_id, ReaderHistory.action, func.count(func.distinct(ReaderHistory.book_id)))
+    rows = rows.filter(ReaderHistory.reader_id.in_(user_ids)).group_by(ReaderHistory.reader_id, ReaderHistory.action)
+    for user_id, action, n in rows:
+        counts.setdefault(user_id, {})[action] = n
+    return counts
+
+
 def save_website(session, book_id, provider_key, provider_value):
     if provider_key != douban.KEY:
         return